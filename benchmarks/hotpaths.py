@@ -0,0 +1,219 @@
+"""
+Benchmark suite for the read, decode, diff and write hot paths, plus bulk reads and monitoring.
+Runs on synthetic saves made from the current layout and writes JSON that can be compared between commits:
+
+    python benchmarks/hotpaths.py -o before.json
+    python benchmarks/hotpaths.py --against before.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Any, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import makeSaves  # noqa: E402
+from reader import Reader  # noqa: E402
+from util.fields import fields  # noqa: E402
+from util.save import Save, convertFromHex, convertToHex  # noqa: E402
+from writer import Writer  # noqa: E402
+
+
+def measure(function: Callable[[], Any], minTime: float = 0.2, repeat: int = 5) -> Dict[str, float]:
+    """
+    Time a function, running it enough times per repeat to take at least minTime
+    :param function: Function to time
+    :param minTime: Minimum seconds per repeat
+    :param repeat: Number of repeats
+    :return: Dict of {ops, min_ns, median_ns} per call
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        taken = time.perf_counter() - start
+        if taken >= minTime / 10:
+            break
+        number *= 10
+    number = max(1, int(number * minTime / max(taken, 1e-9)))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {"ops": number, "min_ns": min(times) * 1e9, "median_ns": statistics.median(times) * 1e9}
+
+
+def coreBenchmarks(directory, minTime: float) -> Dict[str, Dict[str, float]]:
+    """
+    Time single save operations
+    :param directory: Folder to make saves in
+    :param minTime: Minimum seconds per repeat
+    :return: Dict of {benchmark: timings}
+    """
+    first, second = makeSaves(directory, 2, name="core_{}.sav")
+    reader = Reader()
+    writer = Writer()
+    firstSave = reader.readFile(first, Save())
+    secondSave = reader.readFile(second, Save())
+    hexValues = {field.name: convertToHex(firstSave.__getattribute__(field.name)) for field in fields}
+    results = {
+        "Reader.readFile": measure(lambda: reader.readFile(first, Save()), minTime),
+        "Reader.readBuffer": measure(lambda: reader.readBuffer(first), minTime),
+        "Reader.compare saves": measure(lambda: reader.compare(secondSave, firstSave), minTime),
+        "Reader.compare files": measure(lambda: reader.compare(second, first), minTime),
+        "Save.get all": measure(lambda: [firstSave.get(field.name) for field in fields], minTime),
+        "Save.set all": measure(lambda: [secondSave.set(name, hexValues[name]) for name in hexValues], minTime),
+        "Save.get by offset": measure(lambda: [firstSave.get(field.offset) for field in fields], minTime),
+        "Writer.writeFile": measure(lambda: writer.writeFile(second, saveOverride=firstSave), minTime),
+        "Writer.patchFile": measure(lambda: writer.patchFile(second, {fields[0].name: firstSave.__getattribute__(
+            fields[0].name)}), minTime),
+    }
+    for valueType in (int, str, list):
+        field = next((field for field in fields if field.type == valueType), None)
+        if field is None:
+            continue
+        value = firstSave.__getattribute__(field.name)
+        hexValue = convertToHex(value)
+        results[f'convertToHex {valueType.__name__}'] = measure(lambda: convertToHex(value), minTime)
+        results[f'convertFromHex {valueType.__name__}'] = measure(lambda: convertFromHex(hexValue, valueType),
+                                                                  minTime)
+    return results
+
+
+def bulkBenchmarks(directory, count: int) -> Dict[str, Dict[str, float]]:
+    """
+    Time reading many saves at once
+    :param directory: Folder to make saves in
+    :param count: Number of saves
+    :return: Dict of {benchmark: timings per save}
+    """
+    files = makeSaves(directory, count, seed=100, name="bulk_{}.sav")
+    reader = Reader()
+    results = {}
+    for name, function in (
+            ("bulk readFile loop", lambda: [reader.readFile(file, Save()) for file in files]),
+            ("bulk readMany", lambda: list(reader.readMany(files))),
+            ("bulk readMany unordered", lambda: list(reader.readMany(files, ordered=False))),
+            ("bulk readMany 4 threads unordered", lambda: list(reader.readMany(files, 4, ordered=False))),
+    ):
+        timings = measure(function, 0, 3)
+        results[name] = {"ops": count, "min_ns": timings["min_ns"] / count, "median_ns": timings["median_ns"] / count}
+    return results
+
+
+def monitorBenchmarks(directory, changes: int) -> Dict[str, Dict[str, float]]:
+    """
+    Time how long the monitor takes to report a change, and how much an unchanged check costs
+    :param directory: Folder to make saves in
+    :param changes: Number of changes to time
+    :return: Dict of {benchmark: timings}
+    """
+    from monitor import Monitor
+    from util.watcher import SaveWatcher
+
+    file, = makeSaves(directory, 1, seed=200, name="monitor_{}.sav")
+    writer = Writer()
+    name = next(field.name for field in fields if field.type == int)
+    results = {}
+    with SaveWatcher(file) as watcher:
+        watcher.poll()
+        results["SaveWatcher.changed unchanged"] = measure(watcher.changed, 0.1)
+
+    latencies = []
+    with Monitor([file], interval=0.01) as monitor:
+        next(monitor.events(5))
+        for i in range(changes):
+            start = time.perf_counter()
+            writer.patchFile(file, {name: i})
+            for event in monitor.events(5):
+                if name in event.changes:
+                    break
+            latencies.append(time.perf_counter() - start)
+    if latencies:
+        results["Monitor change latency"] = {"ops": len(latencies), "min_ns": min(latencies) * 1e9,
+                                             "median_ns": statistics.median(latencies) * 1e9}
+    return results
+
+
+def compareResults(results: Dict[str, Dict[str, float]], against: Dict[str, Dict[str, float]], threshold: float) \
+        -> List[str]:
+    """
+    Find benchmarks that got slower
+    :param results: New results
+    :param against: Old results
+    :param threshold: Slowdown ratio counted as a regression, e.g. 1.2 for 20% slower
+    :return: List of regression descriptions
+    """
+    regressions = []
+    for name, timings in results.items():
+        if name not in against:
+            continue
+        ratio = timings["min_ns"] / max(against[name]["min_ns"], 1e-9)
+        line = f'{name:<34} {against[name]["min_ns"]:12.0f}ns -> {timings["min_ns"]:12.0f}ns  x{ratio:.2f}'
+        print(line, file=sys.stderr)
+        if ratio > threshold:
+            regressions.append(line)
+    return regressions
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None) -> int:
+    """
+    Run the benchmarks
+    :param argv: Command line arguments. Ignore to use sys.argv
+    :return: Exit code, 1 if compared against earlier results and something regressed
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the save read, decode, diff and write paths")
+    parser.add_argument("-o", "--output", default="-", help="file to write JSON results to (default: stdout)")
+    parser.add_argument("-a", "--against", help="earlier JSON results to compare with")
+    parser.add_argument("-t", "--threshold", type=float, default=1.25,
+                        help="slowdown counted as a regression when comparing (default: 1.25)")
+    parser.add_argument("-m", "--min-time", type=float, default=0.2, help="minimum seconds per repeat")
+    parser.add_argument("-b", "--bulk", type=int, default=500, help="saves in the bulk benchmarks (default: 500)")
+    parser.add_argument("-c", "--changes", type=int, default=20,
+                        help="changes in the monitor benchmark, 0 to skip it (default: 20)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = coreBenchmarks(directory, args.min_time)
+        if args.bulk:
+            results.update(bulkBenchmarks(directory, args.bulk))
+        if args.changes:
+            results.update(monitorBenchmarks(directory, args.changes))
+
+    report = {"commit": _commit(), "python": sys.version.split()[0], "platform": sys.platform, "time": time.time(),
+              "results": results}
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        output.write(json.dumps(report, indent=2) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    if args.against:
+        with open(args.against) as old:
+            regressions = compareResults(results, json.load(old)["results"], args.threshold)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
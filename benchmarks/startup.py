@@ -0,0 +1,117 @@
+"""
+Startup time benchmark for the headless reader and command line paths.
+Every run spawns a fresh interpreter, as scripts calling the reader once per file do.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Modules the headless paths should never load
+GUI_MODULES = ["tkinter", "playsound", "winfiletime", "miniaudio", "display"]
+# Modules that are only loaded on first use
+LAZY_MODULES = ["asyncio", "concurrent.futures", "sqlite3", "mmap", "multiprocessing", "util.watcher", "util.sinks"]
+
+
+def timeRuns(command: List[str], runs: int) -> Dict[str, float]:
+    """
+    Time a command in fresh processes
+    :param command: Command to run
+    :param runs: Number of times to run it
+    :return: Dict of {min, median, max} seconds
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "max": max(times)}
+
+
+def loadedModules(code: str) -> List[str]:
+    """
+    Get the GUI and lazily loaded modules that some code imports
+    :param code: Python code to run
+    :return: List of module names
+    """
+    check = f'{code}\nimport sys\nprint(",".join(m for m in {GUI_MODULES + LAZY_MODULES!r} if m in sys.modules))'
+    output = subprocess.run([sys.executable, "-c", check], cwd=ROOT, check=True, capture_output=True, text=True)
+    return [module for module in output.stdout.rstrip("\n").split("\n")[-1].split(",") if module]
+
+
+def _anyInt() -> str:
+    """
+    Get the name of any int value in the layout, for the patch scenario
+    :return: Value name
+    """
+    from util.fields import fields
+    return next(field.name for field in fields if field.type == int)
+
+
+def main(argv=None) -> int:
+    """
+    Run the benchmark
+    :param argv: Command line arguments. Ignore to use sys.argv
+    :return: Exit code, 1 if a headless path imported a GUI or audio module
+    """
+    parser = argparse.ArgumentParser(description="Time interpreter start up for the headless save tools")
+    parser.add_argument("-n", "--runs", type=int, default=20, help="runs per scenario (default: 20)")
+    parser.add_argument("-s", "--save", help="save file to use (default: a synthetic save of the current layout)")
+    parser.add_argument("--json", action="store_true", help="write results as JSON")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        save = os.path.join(directory, "slot_0.sav")
+        if args.save:
+            shutil.copy(args.save, save)
+        else:
+            from benchmarks.synthetic import makeSaveData
+            with open(save, "wb") as savefile:
+                savefile.write(makeSaveData())
+        other = os.path.join(directory, "slot_1.sav")
+        shutil.copy(save, other)
+
+        cli = os.path.join(ROOT, "cli.py")
+        scenarios = {
+            "python": ([sys.executable, "-c", "pass"], "pass"),
+            "import reader": ([sys.executable, "-c", "import reader"], "import reader"),
+            "import writer": ([sys.executable, "-c", "import writer"], "import writer"),
+            "import cli": ([sys.executable, "-c", "import cli"], "import cli"),
+            "cli dump": ([sys.executable, cli, "-j", "1", "dump", save],
+                         f'import cli\ncli.main(["-j", "1", "-o", {os.devnull!r}, "dump", {save!r}])'),
+            "cli diff": ([sys.executable, cli, "-j", "1", "diff", save, other],
+                         f'import cli\ncli.main(["-j", "1", "-o", {os.devnull!r}, "diff", {save!r}, {other!r}])'),
+            "cli patch": ([sys.executable, cli, "-j", "1", "patch", other, "--set", f'{_anyInt()}=0'],
+                          f'import cli\ncli.main(["-j", "1", "-o", {os.devnull!r}, "patch", {other!r}, '
+                          f'"--set", "{_anyInt()}=0"])'),
+        }
+        results = {}
+        for name, (command, code) in scenarios.items():
+            results[name] = timeRuns(command, args.runs)
+            results[name]["modules"] = loadedModules(code)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    failed = any(module in GUI_MODULES for result in results.values() for module in result["modules"])
+    if args.json:
+        print(json.dumps({"runs": args.runs, "python": sys.version.split()[0], "results": results}, indent=2))
+    else:
+        for name, result in results.items():
+            print(f'{name:<14} min {result["min"] * 1000:7.1f}ms  median {result["median"] * 1000:7.1f}ms  '
+                  f'max {result["max"] * 1000:7.1f}ms  {", ".join(result["modules"])}')
+        if failed:
+            print("A headless path imported a GUI or audio module")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""Synthetic save files generated from the current layout, so benchmarks don't need real saves"""
+import os
+import random
+from typing import List, Optional
+
+from util.codec import codec
+from util.fields import fields
+from util.save import Save
+
+
+def randomSave(rng: random.Random) -> Save:
+    """
+    Make a save with a random value at every known location
+    :param rng: Random number generator to use
+    :return: Save data
+    """
+    save = Save()
+    for field in fields:
+        if field.type == int:
+            value = rng.getrandbits(8 * field.length)
+        elif field.type == str:
+            value = "".join(rng.choice("0123456789.") for _ in range(field.length))
+        else:
+            value = [rng.getrandbits(16) for _ in range(3)]
+        save.__setattr__(field.name, value)
+    return save
+
+
+def makeSaveData(seed: int = 0, padding: int = 4096) -> bytes:
+    """
+    Make the raw data of a random save
+    :param seed: Seed for the random values
+    :param padding: Bytes of random data after the last known location, like the rest of a real save
+    :return: Raw save data
+    """
+    rng = random.Random(seed)
+    data = bytearray(rng.getrandbits(8) for _ in range(codec.end + padding))
+    codec.encodeInto(data, randomSave(rng))
+    return bytes(data)
+
+
+def makeSaves(directory, count: int, seed: int = 0, padding: int = 4096, name: Optional[str] = None) -> List[str]:
+    """
+    Write random save files
+    :param directory: Folder to write into
+    :param count: Number of saves
+    :param seed: Seed for the first save, each one after uses the next seed
+    :param padding: Bytes of random data after the last known location
+    :param name: File name format with one {} for the index. Ignore to use slot_{}.sav
+    :return: List of file paths
+    """
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, (name or "slot_{}.sav").format(i))
+        with open(path, "wb") as savefile:
+            savefile.write(makeSaveData(seed + i, padding))
+        paths.append(path)
+    return paths
@@ -0,0 +1,314 @@
+"""Headless command line tool for dumping, diffing, patching, exporting, packing and indexing many save files"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import sys
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator, Callable
+
+from reader import Reader
+from util.layouts import Layout
+
+# The writer, process pool, snapshot store, archive and timeline modules, and the known locations, are only imported by
+# the commands that use them, so scripts calling dump, diff or patch once per file don't pay for the others on every
+# start
+
+
+def expandPaths(patterns: Iterable[str]) -> List[str]:
+    """
+    Expand glob patterns into a sorted list of unique save files
+    :param patterns: File paths or glob patterns
+    :return: List of file paths
+    """
+    found = []
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True)
+        found.extend(sorted(matches) if matches else [pattern])
+    return [path for path in dict.fromkeys(found) if not os.path.isdir(path)]
+
+
+def parseValue(name: str, value: str, layout: Optional[Layout] = None) -> Any:
+    """
+    Convert a command line value to the type stored at the named save location.
+    Raises KeyError if the layout doesn't have the location, and ValueError if the value doesn't fit in it
+    :param name: Save value name
+    :param value: Value as given on the command line
+    :param layout: Layout of the save the value is for. Ignore to accept a value that fits any layout's location
+    :return: Converted value
+    """
+    if layout is None:
+        from util.layouts import layouts
+        error = KeyError("No such save value currently known: " + str(name))
+        for known in layouts:
+            if name in known.fieldsByName:
+                try:
+                    return parseValue(name, value, known)
+                except ValueError as layoutError:
+                    error = layoutError
+        raise error
+    field = layout.fieldsByName.get(name)
+    if field is None:
+        raise KeyError(f'No such save value in the {layout.version or "default"} layout: {name}')
+    if field.type == int:
+        converted = int(value, 0)
+        if not 0 <= converted < 1 << field.length * 8:
+            raise ValueError(f'{converted} does not fit in {field.length} unsigned bytes')
+        return converted
+    elif field.type == list:
+        converted = [int(listval, 0) for listval in value.split(",")]
+        if len(converted) != field.length // 2:
+            raise ValueError(f'expected {field.length // 2} comma separated values, got {len(converted)}')
+        for listval in converted:
+            if not 0 <= listval <= 0xFFFF:
+                raise ValueError(f'{listval} does not fit in 2 unsigned bytes')
+        return converted
+    if len(value.encode("latin-1")) > field.length:
+        raise ValueError(f'longer than {field.length} characters')
+    return value
+
+
+def _dump(path: str) -> Dict[str, Any]:
+    save = Reader().readFile(path)
+    # Every value of the save's own layout, including ones only some game versions have
+    return {"path": path, "save": {field.name: save.__getattribute__(field.name) for field in save.layout.fields}}
+
+
+def _diff(paths: Tuple[str, str]) -> Dict[str, Any]:
+    path, against = paths
+    changes = Reader().compare(path, against)
+    return {"path": path, "against": against, "changes": {change: list(changes[change]) for change in changes}}
+
+
+def _patch(job: Tuple[str, Dict[str, str]]) -> Dict[str, Any]:
+    from writer import Writer
+    path, values = job
+    # Each save's values are checked against the layout of its own game version, which may keep them in fewer bytes
+    reader = Reader()
+    layout = reader.layoutOf(reader.readBuffer(path), path)
+    values = {name: parseValue(name, value, layout) for name, value in values.items()}
+    Writer().patchFile(path, values)
+    return {"path": path, "patched": values}
+
+
+def _safely(task: Callable[[Any], Dict[str, Any]], job: Any) -> Dict[str, Any]:
+    try:
+        return task(job)
+    except Exception as error:
+        return {"path": job[0] if type(job) == tuple else job, "error": f'{type(error).__name__}: {error}'}
+
+
+def runJobs(task: Callable[[Any], Dict[str, Any]], jobs: List[Any], workers: Optional[int] = None) \
+        -> Iterator[Dict[str, Any]]:
+    """
+    Run a task over every job in a process pool, yielding the results in order
+    :param task: Top level function to run on each job
+    :param jobs: Jobs to run
+    :param workers: Number of processes. 1 runs everything in this process
+    :return: Iterator of results
+    """
+    if workers == 1 or len(jobs) < 2:
+        for job in jobs:
+            yield _safely(task, job)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4))
+        yield from pool.map(_safely, [task] * len(jobs), jobs, chunksize=chunksize)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Run the command line tool
+    :param argv: Command line arguments. Ignore to use sys.argv
+    :return: Exit code
+    """
+    parser = argparse.ArgumentParser(description="Read, compare and patch Planet of Lana save files in bulk. "
+                                                 "Results are written as JSON Lines.")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+    parser.add_argument("-o", "--output", default="-", help="file to write results to (default: stdout)")
+    parser.add_argument("--metrics", default=os.getenv("POL_METRICS"), metavar="FILE",
+                        help="record timings and I/O counts to FILE, as Prometheus text if it ends in .prom and JSON "
+                             "otherwise. Work done in worker processes is only included with -j 1 "
+                             "(default: $POL_METRICS)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    dump = commands.add_parser("dump", help="decode every known value in each save")
+    dump.add_argument("paths", nargs="+", help="save files or glob patterns")
+
+    diff = commands.add_parser("diff", help="compare each save with the one before it, or with a base save")
+    diff.add_argument("paths", nargs="+", help="save files or glob patterns")
+    diff.add_argument("-b", "--base", help="save file to compare every save against")
+
+    patch = commands.add_parser("patch", help="write values into each save")
+    patch.add_argument("paths", nargs="+", help="save files or glob patterns")
+    patch.add_argument("-s", "--set", dest="values", action="append", required=True, metavar="NAME=VALUE",
+                       help="value to write, lists are comma separated (repeatable)")
+
+    export = commands.add_parser("export", help="write logged snapshots back out as save files")
+    export.add_argument("store", help="snapshot store folder")
+    export.add_argument("-s", "--session", help="only export this session")
+    export.add_argument("-d", "--directory", default=".", help="folder to export into (default: .)")
+
+    pack = commands.add_parser("pack", help="pack saves or snapshot stores into a single archive")
+    pack.add_argument("archive", help="archive file to create")
+    pack.add_argument("paths", nargs="+", help="save files, glob patterns or snapshot store folders")
+    pack.add_argument("-r", "--raw", action="store_true", help="keep each full save, not just the known locations")
+
+    timeline = commands.add_parser("timeline", help="index snapshot folders into a database and query it")
+    timeline.add_argument("database", help="SQLite database to keep the index in")
+    timeline.add_argument("folders", nargs="*", help="snapshot stores or folders of saves to index first")
+    timeline.add_argument("-s", "--session", help="only query this session")
+    timeline.add_argument("-f", "--first", action="append", metavar="NAME=VALUE",
+                          help="find the first snapshot with this value (repeatable)")
+    timeline.add_argument("-d", "--deaths", action="store_true", help="count deaths per chapter")
+
+    args = parser.parse_args(argv)
+    if args.metrics:
+        from util import metrics
+        metrics.fromSpec(args.metrics)
+    if args.command == "export":
+        return _writeResults(exportSnapshots(args.store, args.directory, args.session), args.output)
+    if args.command == "pack":
+        return _writeResults(packArchive(args.archive, args.paths, args.raw), args.output)
+    if args.command == "timeline":
+        from util.layouts import layouts
+        conditions = {}
+        for value in args.first or []:
+            name, _, value = value.partition("=")
+            listName, _, item = name.rpartition("_")
+            try:
+                if name not in layouts.names and item.isdigit() and listName in layouts.names:
+                    conditions[name] = int(value, 0)
+                else:
+                    conditions[name] = parseValue(name, value)
+            except (KeyError, ValueError) as error:
+                parser.error(f'invalid value {name}={value}: {error}')
+            if type(conditions[name]) == list:
+                parser.error(f'invalid value {name}={value}: search list values by item, e.g. {name}_0=VALUE')
+        return _writeResults(queryTimeline(args.database, args.folders, args.session, conditions, args.deaths),
+                             args.output)
+    paths = expandPaths(args.paths)
+
+    if args.command == "dump":
+        results = runJobs(_dump, paths, args.jobs)
+    elif args.command == "diff":
+        if args.base:
+            jobs = [(path, args.base) for path in paths]
+        else:
+            jobs = list(zip(paths[1:], paths[:-1]))
+        results = runJobs(_diff, jobs, args.jobs)
+    else:
+        values = {}
+        for value in args.values:
+            name, _, value = value.partition("=")
+            try:
+                parseValue(name, value)
+            except (KeyError, ValueError) as error:
+                parser.error(f'invalid value {name}={value}: {error}')
+            values[name] = value
+        results = runJobs(_patch, [(path, values) for path in paths], args.jobs)
+
+    return _writeResults(results, args.output)
+
+
+def exportSnapshots(store, directory, session: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Export logged snapshots as save files named after when they were taken, in a folder per session
+    :param store: Snapshot store folder
+    :param directory: Folder to export into
+    :param session: Optional session to limit the export to
+    :return: Iterator of results
+    """
+    from util.snapshots import SnapshotStore
+    snapshots = SnapshotStore(store)
+    used = set()
+    for entry in snapshots.entries(session):
+        name = datetime.datetime.fromtimestamp(entry.time).strftime("%Y%m%d - %H%M%S")
+        path = os.path.join(directory, entry.session or "snapshots", name + ".sav")
+        count = 1
+        while path in used:
+            count += 1
+            path = os.path.join(directory, entry.session or "snapshots", f'{name} ({count}).sav')
+        used.add(path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            snapshots.export(entry, path)
+            yield {"path": path, "hash": entry.hash, "time": entry.time}
+        except (OSError, ValueError) as error:
+            yield {"path": path, "error": f'{type(error).__name__}: {error}'}
+
+
+def packArchive(archive, paths: List[str], raw: bool = False) -> Iterator[Dict[str, Any]]:
+    """
+    Pack save files and snapshot stores into one archive, in the order given
+    :param archive: Archive file to create
+    :param paths: Save files, glob patterns or snapshot store folders
+    :param raw: Whether to keep each full save, not just the known locations
+    :return: Iterator of results
+    """
+    from util.archive import ArchiveWriter
+    from util.snapshots import SnapshotStore
+    packed = 0
+    with ArchiveWriter(archive, raw) as writer:
+        for path in paths:
+            if os.path.exists(os.path.join(path, "index.jsonl")):
+                snapshots = SnapshotStore(path)
+                for entry in snapshots.entries():
+                    writer.add(snapshots.load(entry), entry.time)
+                    packed += 1
+                continue
+            for file in expandPaths([path]):
+                try:
+                    writer.addFile(file)
+                    packed += 1
+                except (OSError, ValueError) as error:
+                    yield {"path": file, "error": f'{type(error).__name__}: {error}'}
+    yield {"path": archive, "saves": packed}
+
+
+def queryTimeline(database, folders: List[str], session: Optional[str], first: Dict[str, Any], deaths: bool) \
+        -> Iterator[Dict[str, Any]]:
+    """
+    Update a timeline index with any new snapshots and run the requested queries on it
+    :param database: SQLite database to keep the index in
+    :param folders: Snapshot stores or folders of saves to index
+    :param session: Optional session to query
+    :param first: Values to find the first snapshot with
+    :param deaths: Whether to count the deaths per chapter
+    :return: Iterator of results
+    """
+    from util.timeline import Timeline
+    timeline = Timeline(database)
+    try:
+        for folder in folders:
+            yield {"path": folder, "indexed": timeline.update(folder)}
+        if first:
+            yield {"first": first, "snapshot": timeline.first(session, **first)}
+        if deaths:
+            yield {"deathsPerChapter": timeline.deathsPerChapter(session)}
+    finally:
+        timeline.close()
+
+
+def _writeResults(results: Iterable[Dict[str, Any]], output) -> int:
+    """
+    Write results as JSON Lines
+    :param results: Results to write
+    :param output: File to write to, or - for stdout
+    :return: Exit code
+    """
+    failed = False
+    output = sys.stdout if output == "-" else open(output, "w")
+    try:
+        for result in results:
+            failed = failed or "error" in result
+            output.write(json.dumps(result) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,24 @@
 """Display class and functions for a GUI"""
+import copy
 import datetime
 import os
+import queue
+import threading
 import tkinter as tk
 import winfiletime
 from tkinter import filedialog as fd
-from typing import List, Union, Optional
+from concurrent.futures import Future
+from typing import List, Union, Optional, Callable, Any, Tuple
 import shutil
 
+from monitor import Monitor, MonitorEvent
 from reader import Reader
+from util import background, metrics
+from util.bindings import Bindings, Binding
+from util.notify import Notifier
 from util.save import Save
+from util.snapshots import SnapshotStore
 from writer import Writer
-from playsound import playsound
 
 
 class Display:
@@ -28,6 +36,8 @@ class Display:
         self.mode = "EDIT"
         self.mainvals = []
         self.compvals = []
+        self.__mainBindings: Optional[Bindings] = None
+        self.__compBindings: Optional[Bindings] = None
         self._buttons = {
             "LEFT": [],
             "RIGHT": []
@@ -42,8 +52,19 @@ class Display:
         self.__scene: List[bool, Optional[tk.Button]] = [True, None]
         self.__position: List[bool, Optional[tk.Button]] = [False, None]
         self.__shrines: List[bool, Optional[tk.Button]] = [False, None]
+        self.__alerts = {
+            "timestamp": self.__timestamp, "version": self.__version, "elapsed": self.__elapsed,
+            "deathcounter": self.__deaths, "slot": self.__slot, "chapterId": self.__chapter, "sceneId": self.__scene,
+            "position": self.__position
+        }
         self._logging: List[bool, Optional[tk.Button], int] = [True, None, 0]
-        self.__lastFile = ""
+        self.__monitor: Optional[Monitor] = None
+        self.__pollJob: Optional[str] = None
+        self.__updates: "queue.Queue[Tuple[Monitor, MonitorEvent]]" = queue.Queue()
+        self.__snapshots: Optional[SnapshotStore] = None
+        self.__snapshotLock = threading.Lock()
+        self.__notifier = Notifier("snd_fragment_retrievewav-14728.mp3")
+        metrics.fromEnvironment()
 
     def run(self):
         """
@@ -53,6 +74,11 @@ class Display:
         self._window.mainloop()
 
     def __setupMainGui(self):
+        self.__stopMonitor()
+        # Draw anything still waiting now, as its widgets are about to go
+        for bindings in (self.__mainBindings, self.__compBindings):
+            if bindings is not None:
+                bindings.flush()
         win = self._window
         if self._main:
             self._main.destroy()
@@ -75,190 +101,179 @@ class Display:
         self._monitorButton = tk.Button(left_cont, text="Monitor", command=self.__setupConstantCompareGui)
         self._monitorButton.pack(fill=tk.X, expand=True)
 
-    def __setupToolbarGui(self, cont, save, side):
-        but1 = tk.Button(cont, text="1", command=lambda: self.__buttonPress(lambda: self._reader.readFile(
-            f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\slot_0.sav', saveOverride=save),
-                                                                            side, 0)
-                         )
+    def __setupToolbarGui(self, cont, side):
+        but1 = tk.Button(cont, text="1", command=lambda: self.__buttonPress(
+            lambda: self.__readInBackground(
+                f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\slot_0.sav'),
+            side, 0))
         but1.pack(fill=tk.X, expand=True, side=tk.LEFT)
-        but2 = tk.Button(cont, text="2", command=lambda: self.__buttonPress(lambda: self._reader.readFile(
-            f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\slot_1.sav', saveOverride=save),
-                                                                            side, 1)
-                         )
+        but2 = tk.Button(cont, text="2", command=lambda: self.__buttonPress(
+            lambda: self.__readInBackground(
+                f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\slot_1.sav'),
+            side, 1))
         but2.pack(fill=tk.X, expand=True, side=tk.LEFT)
-        but3 = tk.Button(cont, text="3", command=lambda: self.__buttonPress(lambda: self._reader.readFile(
-            f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\slot_2.sav', saveOverride=save),
-                                                                            side, 2)
-                         )
+        but3 = tk.Button(cont, text="3", command=lambda: self.__buttonPress(
+            lambda: self.__readInBackground(
+                f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\slot_2.sav'),
+            side, 2))
         but3.pack(fill=tk.X, expand=True, side=tk.LEFT)
-        but4 = tk.Button(cont, text="Custom", command=lambda: self.__buttonPress(lambda: self.__openCustom(save),
-                                                                                 side, 3))
+        but4 = tk.Button(cont, text="Custom", command=lambda: self.__buttonPress(self.__openCustom, side, 3))
         but4.pack(fill=tk.X, expand=True, side=tk.LEFT)
         self._buttons[side] = [but1, but2, but3, but4]
 
-    def __buttonPress(self, action, side, button=4):
-        action()
+    def __buttonPress(self, action: Callable[[], Optional[Future]], side, button=4):
+        future = action()
+        if future is not None:
+            self.__whenDone(future, lambda: self.__afterRead(side, button, future.result()))
+
+    def __readInBackground(self, file) -> Future:
+        """
+        Read a save file on the shared I/O thread into a new save, so the saves the window shows are never written to
+        off the Tk loop
+        :param file: File to read
+        :return: Future for the new save
+        """
+        return self._reader.readFileInBackground(file, saveOverride=Save())
+
+    def __whenDone(self, future: Future, callback: Callable[[], Any],
+                   onError: Optional[Callable[[BaseException], Any]] = None):
+        """
+        Poll a background task from the Tk loop and run the callback on the UI thread once it finishes
+        :param future: Background task
+        :param callback: Function to run after the task
+        :param onError: Function to run with the task's error if it failed. Ignore to raise the error
+        """
+        if not future.done():
+            self._window.after(20, lambda: self.__whenDone(future, callback, onError))
+            return
+        if onError is not None and future.exception() is not None:
+            onError(future.exception())
+            return
+        # Raise any error from the task here so Tk reports it like any other callback error
+        future.result()
+        callback()
+
+    def __afterRead(self, side, button, save: Save):
+        # Swapped in here on the Tk loop, once the read has finished with it
+        if side == "LEFT":
+            self._mainsave = save
+        else:
+            self._compsave = save
         if self.mode == "EDIT":
-            self.__changeVals(self.mainvals, self._mainsave)
+            self.__mainBindings.render(self._mainsave)
         if self.mode == "COMPARE":
             if side == "LEFT":
-                self.__changeVals(self.mainvals, self._mainsave)
+                self.__mainBindings.render(self._mainsave)
             else:
-                self.__changeVals(self.compvals, self._compsave)
+                self.__compBindings.render(self._compsave)
             if self._mainsave.version is not None and self._compsave.version is not None:
                 self.__checkCompare()
         if self.mode == "MONITOR":
-            self.__changeVals(self.mainvals, self._mainsave)
-            self._window.after(1, self.__constantCompare)
+            self.__mainBindings.render(self._mainsave)
+            self.__startMonitor(self._reader.lastFile)
 
         if button < len(self._buttons[side]):
             for but in self._buttons[side]:
                 but["relief"] = tk.RAISED
             self._buttons[side][button]["relief"] = tk.SUNKEN
 
-    def __constantCompare(self):
-        if self.mode != "MONITOR":
+    def __startMonitor(self, file):
+        """
+        Start watching a save file on background threads. Reading, comparing, logging and alerts all happen off the
+        Tk loop, which only receives the finished updates through a queue
+        :param file: Save file to watch
+        """
+        self.__stopMonitor()
+        if not file:
             return
-        newSave = Save()
-        currFile = self._reader.lastFile[:]
-        self._reader.readFile(self._reader.lastFile, newSave)
-        changes = self._reader.compare(newSave, self._mainsave)
-        if len(changes) or self.__lastFile == "":
+        # Whole files are read so the events can be logged as they are, without reading the file again
+        monitor = self.__monitor = Monitor([file], workers=1, interval=0.1, idleInterval=0.5, full=True)
+        monitor.start()
+        threading.Thread(target=self.__monitorLoop, args=(monitor,), name="display-monitor", daemon=True).start()
+        self.__pollUpdates()
+
+    def __stopMonitor(self):
+        if self.__pollJob is not None:
+            self._window.after_cancel(self.__pollJob)
+            self.__pollJob = None
+        if self.__monitor is not None:
+            # Stopping waits for reads in progress, so leave that to another thread too
+            threading.Thread(target=self.__monitor.stop, name="display-monitor-stop", daemon=True).start()
+            self.__monitor = None
+
+    def __monitorLoop(self, monitor: Monitor):
+        """
+        Worker thread handling everything the monitor finds for the watched file
+        :param monitor: Monitor to take events from
+        """
+        for event in monitor.events():
             if self._logging[0]:
                 if not self._logging[2]:
                     self._logging[2] = int(datetime.datetime.now().timestamp())
-                if self._reader.lastFile:
-                    os.makedirs(f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\'
-                                f'{datetime.datetime.fromtimestamp(self._logging[2]).strftime("%Y%m%d - %H%M%S")}'
-                                , exist_ok=True)
-                    shutil.copy(self._reader.lastFile,
-                                f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\'
-                                f'{datetime.datetime.fromtimestamp(self._logging[2]).strftime("%Y%m%d - %H%M%S")}'
-                                f'\\{datetime.datetime.now().strftime("%Y%m%d - %H%M%S")}.sav')
-
-        if currFile != self.__lastFile:
-            self.__lastFile = currFile
-            print("skipped")
-            self._window.after(10000, self.__constantCompare)
+                try:
+                    self.__snapshotStore().add(
+                        event.data, datetime.datetime.fromtimestamp(self._logging[2]).strftime("%Y%m%d - %H%M%S"),
+                        event.time)
+                except OSError as error:
+                    print("Could not log snapshot: " + str(error))
+            self.__updates.put((monitor, event))
+            alerts = [change for change in event.changes if change in self.__alerts and self.__alerts[change][0]]
+            if alerts:
+                self.__notifier.notify(", ".join(alerts))
+
+    def __pollUpdates(self):
+        """
+        Apply the newest monitor update to the window, skipping any older ones still waiting
+        """
+        self.__pollJob = None
+        if self.mode != "MONITOR" or self.__monitor is None:
             return
-        self.__lastFile = currFile
-        ding = False
-        if "timestamp" in changes:
-            self.mainvals[0]["fg"] = "red"
-            if self.__timestamp[0]:
-                ding = True
-        else:
-            self.mainvals[0]["fg"] = "black"
-        if "version" in changes:
-            self.mainvals[1]["fg"] = "red"
-            if self.__version[0]:
-                ding = True
-        else:
-            self.mainvals[1]["fg"] = "black"
-        if "elapsed" in changes:
-            self.mainvals[2]["fg"] = "red"
-            if self.__elapsed[0]:
-                ding = True
-        else:
-            self.mainvals[2]["fg"] = "black"
-        if "deathcounter" in changes:
-            self.mainvals[3]["fg"] = "red"
-            if self.__deaths[0]:
-                ding = True
-        else:
-            self.mainvals[3]["fg"] = "black"
-        if "slot" in changes:
-            self.mainvals[4]["fg"] = "red"
-            if self.__slot[0]:
-                ding = True
-        else:
-            self.mainvals[4]["fg"] = "black"
-        if "chapterId" in changes:
-            self.mainvals[5]["fg"] = "red"
-            if self.__chapter[0]:
-                ding = True
-        else:
-            self.mainvals[5]["fg"] = "black"
-        if "sceneId" in changes:
-            self.mainvals[6]["fg"] = "red"
-            if self.__scene[0]:
-                ding = True
-        else:
-            self.mainvals[6]["fg"] = "black"
-        if "position" in changes:
-            if changes["position"][0][0] != changes["position"][1][0]:
-                self.mainvals[7][0]["fg"] = "red"
-                if self.__position[0]:
-                    ding = True
-            else:
-                self.mainvals[7][0]["fg"] = "black"
-            if changes["position"][0][1] != changes["position"][1][1]:
-                self.mainvals[7][1]["fg"] = "red"
-                if self.__position[0]:
-                    ding = True
-            else:
-                self.mainvals[7][1]["fg"] = "black"
-            if changes["position"][0][2] != changes["position"][1][2]:
-                self.mainvals[7][2]["fg"] = "red"
-                if self.__position[0]:
-                    ding = True
-            else:
-                self.mainvals[7][2]["fg"] = "black"
-        self.__changeVals(self.mainvals, newSave)
-        self._mainsave = newSave
-        if ding:
-            playsound("snd_fragment_retrievewav-14728.mp3")
-        self._window.after(10000, self.__constantCompare)
+        latest = None
+        while True:
+            try:
+                update = self.__updates.get_nowait()
+            except queue.Empty:
+                break
+            if update[0] is self.__monitor:
+                latest = update
+        if latest is not None:
+            _, event = latest
+            self.__mainBindings.render(event.save, event.changes)
+            self._mainsave = event.save
+        self.__pollJob = self._window.after(50, self.__pollUpdates)
 
     def __checkCompare(self):
-        for i in range(8):
-            if type(self.mainvals[i]) != list:
-                if self.mainvals[i]["text"] != self.compvals[i]["text"]:
-                    self.mainvals[i]["fg"] = "red"
-                    self.compvals[i]["fg"] = "red"
-                else:
-                    self.mainvals[i]["fg"] = "black"
-                    self.compvals[i]["fg"] = "black"
-            else:
-                for j in range(3):
-                    if self.mainvals[i][j]["text"] != self.compvals[i][j]["text"]:
-                        self.mainvals[i][j]["fg"] = "red"
-                        self.compvals[i][j]["fg"] = "red"
-                    else:
-                        self.mainvals[i][j]["fg"] = "black"
-                        self.compvals[i][j]["fg"] = "black"
-
-    def __changeVals(self, vals: List[Union[tk.Entry, tk.Label, List[tk.Entry]]], save):
-        vals[0]["text"] = winfiletime.to_datetime(save.timestamp).strftime("%Y/%m/%d - %H:%M:%S")
-        vals[1]["text"] = save.version
-        vals[2]["text"] = datetime.datetime.fromtimestamp(save.elapsed).strftime("%Hh %Mm %Ss")
-        vals[3]["text"] = str(save.deathcounter)
-        if type(vals[4]) == tk.Entry:
-            vals[4].delete(0, "end")
-            vals[4].insert(0, str(save.slot + 1))
-            vals[5].delete(0, "end")
-            vals[5].insert(0, str(save.chapterId))
-            vals[6].delete(0, "end")
-            vals[6].insert(0, str(save.sceneId))
-            vals[7][0].delete(0, "end")
-            vals[7][0].insert(0, str(save.position[0]))
-            vals[7][1].delete(0, "end")
-            vals[7][1].insert(0, str(save.position[1]))
-            vals[7][2].delete(0, "end")
-            vals[7][2].insert(0, str(save.position[2]))
-        else:
-            vals[4]["text"] = str(save.slot + 1)
-            vals[5]["text"] = str(save.chapterId)
-            vals[6]["text"] = str(save.sceneId)
-            vals[7][0]["text"] = str(save.position[0])
-            vals[7][1]["text"] = str(save.position[1])
-            vals[7][2]["text"] = str(save.position[2])
-
-    def __openCustom(self, save):
+        changes = self._reader.compare(self._compsave, self._mainsave)
+        self.__mainBindings.highlight(changes)
+        self.__compBindings.highlight(changes)
+
+    def __bind(self, vals: List[Union[tk.Entry, tk.Label, List[tk.Label]]]) -> Bindings:
+        """
+        Bind the value widgets made by one of the __setupVals functions to their save values
+        :param vals: Value widgets, in the order the __setupVals functions return them
+        :return: Bindings for the widgets
+        """
+        formats = [
+            ("timestamp", lambda val: winfiletime.to_datetime(val).strftime("%Y/%m/%d - %H:%M:%S")),
+            ("version", str),
+            ("elapsed", lambda val: datetime.datetime.fromtimestamp(val).strftime("%Hh %Mm %Ss")),
+            ("deathcounter", str),
+            ("slot", lambda val: str(val + 1)),
+            ("chapterId", str),
+            ("sceneId", str)
+        ]
+        bindings = [Binding(name, vals[i], valFormat, editable=type(vals[i]) == tk.Entry)
+                    for i, (name, valFormat) in enumerate(formats)]
+        bindings.extend(Binding("position", vals[7][i], index=i, editable=type(vals[7][i]) == tk.Entry)
+                        for i in range(3))
+        return Bindings(self._window, bindings)
+
+    def __openCustom(self):
         file = fd.askopenfilename(initialdir=f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\',
                                   defaultextension="sav", filetypes=(("Save Files", "*.sav"), ("All Files", "*.*")))
         if file:
-            self._reader.readFile(file, saveOverride=save)
+            return self.__readInBackground(file)
+        return None
 
     def __saveAs(self):
         file = fd.asksaveasfilename(initialdir=f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\',
@@ -275,8 +290,9 @@ class Display:
                                    int(self.mainvals[7][1].get()),
                                    int(self.mainvals[7][2].get())]
         self._mainsave.slot = int(self.mainvals[4].get()) - 1
-        self._writer.writeFile(file, saveOverride=self._mainsave)
-        self.__buttonPress(lambda: self._reader.readFile(file, saveOverride=self._mainsave), "LEFT")
+        # The writer gets its own copy, as the window can change the save while it is being written
+        self.__whenDone(self._writer.writeFileInBackground(file, saveOverride=copy.deepcopy(self._mainsave)),
+                        lambda: self.__buttonPress(lambda: self.__readInBackground(file), "LEFT"))
 
     def __setupEditorGui(self):
         self.mode = "EDIT"
@@ -295,7 +311,7 @@ class Display:
         tools_cont = tk.Frame(tools)
         tools_cont.pack(fill=tk.X, side=tk.LEFT)
 
-        self.__setupToolbarGui(tools, self._mainsave, "LEFT")
+        self.__setupToolbarGui(tools, "LEFT")
         tk.Button(tools, text="Save",
                   command=lambda: self.__save(self._reader.lastFile)) \
             .pack(fill=tk.X, expand=True, side=tk.LEFT)
@@ -304,16 +320,36 @@ class Display:
         self._backupButton.pack(fill=tk.X, expand=True, side=tk.LEFT)
 
         self.mainvals = self.__setupValsEntry(right)
+        self.__mainBindings = self.__bind(self.mainvals)
 
     def __backup(self):
         if self._reader.lastFile:
-            os.makedirs(f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\'
-                        f'backups\\'
-                        , exist_ok=True)
-            shutil.copy(self._reader.lastFile,
-                        f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\backups\\'
-                        f'{datetime.datetime.now().strftime("%Y%m%d - %H%M%S")}.sav')
-            self._backupButton["fg"] = "green"
+            self.__whenDone(background.submit(self.__snapshot, "backups", self._reader.lastFile),
+                            lambda: self._backupButton.configure(fg="green"), self.__backupFailed)
+
+    def __backupFailed(self, error: BaseException):
+        self._backupButton["fg"] = "red"
+        print("Could not back up save: " + str(error))
+
+    def __snapshotStore(self) -> SnapshotStore:
+        """
+        Get the snapshot store, opening it on first use. The store is safe to add to from several threads
+        :return: Snapshot store in the saves folder
+        """
+        with self.__snapshotLock:
+            if self.__snapshots is None:
+                self.__snapshots = SnapshotStore(f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\'
+                                                 f'snapshots')
+        return self.__snapshots
+
+    def __snapshot(self, session: str, file):
+        """
+        Log a save file into the snapshot store, only keeping what changed since the last snapshot.
+        Runs off the Tk loop
+        :param session: Session to group the snapshot under
+        :param file: Save file to log
+        """
+        self.__snapshotStore().addFile(file, session)
 
     def __setupValsEntry(self, frame):
         column1 = tk.Frame(frame)
@@ -517,13 +553,10 @@ class Display:
                 if not self._logging[2]:
                     self._logging[2] = int(datetime.datetime.now().timestamp())
                 if self._reader.lastFile:
-                    os.makedirs(f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\'
-                                f'{datetime.datetime.fromtimestamp(self._logging[2]).strftime("%Y%m%d - %H%M%S")}'
-                                , exist_ok=True)
-                    shutil.copy(self._reader.lastFile,
-                                f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\'
-                                f'{datetime.datetime.fromtimestamp(self._logging[2]).strftime("%Y%m%d - %H%M%S")}'
-                                f'\\{datetime.datetime.now().strftime("%Y%m%d - %H%M%S")}.sav')
+                    self.__whenDone(background.submit(
+                        self.__snapshot, datetime.datetime.fromtimestamp(self._logging[2]).strftime("%Y%m%d - %H%M%S"),
+                        self._reader.lastFile), lambda: None,
+                        lambda error: print("Could not log snapshot: " + str(error)))
         else:
             thing[1]["fg"] = "red"
             if len(thing) == 3:
@@ -684,12 +717,14 @@ class Display:
         righttools_cont = tk.Frame(righttools)
         righttools_cont.pack(fill=tk.X, side=tk.RIGHT)
 
-        self.__setupToolbarGui(lefttools, self._mainsave, "LEFT")
+        self.__setupToolbarGui(lefttools, "LEFT")
 
-        self.__setupToolbarGui(righttools, self._compsave, "RIGHT")
+        self.__setupToolbarGui(righttools, "RIGHT")
 
         self.mainvals = self.__setupValsLabel(left, self._mainsave)
         self.compvals = self.__setupValsLabel(right, self._compsave)
+        self.__mainBindings = self.__bind(self.mainvals)
+        self.__compBindings = self.__bind(self.compvals)
 
         self.__checkCompare()
 
@@ -710,7 +745,7 @@ class Display:
         tools_cont = tk.Frame(tools)
         tools_cont.pack(fill=tk.X, side=tk.LEFT)
 
-        self.__setupToolbarGui(tools, self._mainsave, "LEFT")
+        self.__setupToolbarGui(tools, "LEFT")
 
         logButton = tk.Button(tools, text="Log", command=lambda: self.__reverse(self._logging),
                               fg="green" if self._logging[0] else "red")
@@ -718,6 +753,7 @@ class Display:
         self._logging[1] = logButton
 
         self.mainvals, compButtons = self.__setupValsInverse(right)
+        self.__mainBindings = self.__bind(self.mainvals)
         vals = [
             self.__timestamp, self.__version, self.__elapsed, self.__deaths, self.__slot,
             self.__chapter, self.__scene, self.__position, self.__shrines
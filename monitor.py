@@ -0,0 +1,255 @@
+"""Monitor class for watching many save files at once and streaming their changes"""
+import copy
+import glob
+import os
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Tuple, Any, Iterable, Iterator, NamedTuple
+
+from reader import Reader
+from util import metrics
+from util.save import Save
+from util.watcher import SaveWatcher
+
+
+class MonitorEvent(NamedTuple):
+    """
+    A change seen in one monitored save file, with the raw data it was found in. The first read of each file is an
+    initial event carrying its values without any changes, as there is nothing yet to compare it with
+    """
+    path: str
+    changes: Dict[str, Tuple[Any, Any]]
+    save: Save
+    time: float
+    data: bytes
+    initial: bool = False
+
+
+class Monitor:
+    """
+    Monitor class to watch any number of save files and folders, reading and comparing changed files concurrently
+    and merging their changes into a single event feed
+    """
+
+    def __init__(self, paths: Iterable[str], workers: Optional[int] = None, pattern: str = "*.sav",
+                 interval: float = 0.25, rescan: float = 5, idleInterval: float = 1.0, full: bool = False):
+        """
+        :param paths: Save files, or folders to watch every matching save file in
+        :param workers: Maximum threads reading files at once
+        :param pattern: Glob pattern for save files inside watched folders
+        :param interval: Seconds between checks of a file that is changing
+        :param rescan: Seconds between checks for new files in watched folders
+        :param idleInterval: Longest seconds between checks of a file that has stopped changing
+        :param full: Whether events carry the whole file rather than just the data up to its last known location
+        """
+        self.paths = list(paths)
+        self.pattern = pattern
+        self.interval = interval
+        self.rescan = rescan
+        self.idleInterval = max(interval, idleInterval)
+        self.full = full
+        self.__workers = workers
+        self.__events: "queue.Queue[MonitorEvent]" = queue.Queue()
+        self.__watchers: Dict[str, SaveWatcher] = {}
+        self.__readers: Dict[str, Reader] = {}
+        self.__buffers: Dict[str, bytes] = {}
+        self.__busy = set()
+        self.__pending = set()
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+        self.__pool: Optional[ThreadPoolExecutor] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+    def files(self) -> List[str]:
+        """
+        Get every save file currently covered by the monitored paths
+        :return: List of file paths
+        """
+        found = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                found.extend(sorted(glob.glob(os.path.join(path, self.pattern))))
+            else:
+                found.append(path)
+        return list(dict.fromkeys(found))
+
+    def start(self):
+        """
+        Start watching the files in the background
+        """
+        if self.__thread is not None:
+            return
+        self.__stop.clear()
+        self.__pool = ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="monitor")
+        self.__thread = threading.Thread(target=self.__run, name="monitor", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop watching the files and wait for any reads in progress
+        """
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=True)
+            self.__pool = None
+        for watcher in self.__watchers.values():
+            watcher.close()
+        self.__watchers.clear()
+
+    def events(self, timeout: Optional[float] = None) -> Iterator[MonitorEvent]:
+        """
+        Stream changes from every monitored file as they are found
+        :param timeout: Seconds to wait for each event. None to wait until stopped
+        :return: Iterator of events
+        """
+        while not self.__stop.is_set() or not self.__events.empty():
+            try:
+                yield self.__events.get(timeout=timeout if timeout is not None else self.interval)
+            except queue.Empty:
+                if timeout is not None:
+                    return
+
+    def __run(self):
+        lastScan = 0.0
+        while not self.__stop.is_set():
+            if time.monotonic() - lastScan >= self.rescan:
+                lastScan = time.monotonic()
+                for file in self.files():
+                    if file not in self.__watchers and os.path.isfile(file):
+                        watcher = SaveWatcher(file, self.interval, self.idleInterval, full=self.full)
+                        # Not polled until its first read has had time to finish, so it isn't read twice
+                        watcher.due = time.monotonic() + watcher.minInterval
+                        self.__watchers[file] = watcher
+                        self.__readers[file] = Reader()
+                        self.__submit(file)
+            sink = metrics.sink
+            polls = 0
+            for file, watcher in list(self.__watchers.items()):
+                if time.monotonic() < watcher.due:
+                    continue
+                polls += 1
+                # Only the file's stats are checked here, it is read on a worker if they changed
+                if watcher.changed():
+                    watcher.due = time.monotonic() + watcher.minInterval
+                    self.__submit(file)
+                elif sink is not None:
+                    sink.count("monitor_idle_polls_total")
+            if sink is not None and polls:
+                sink.count("monitor_polls_total", polls)
+            wake = min((watcher.due for watcher in self.__watchers.values()), default=time.monotonic() + self.interval)
+            self.__stop.wait(max(0.0, min(wake, lastScan + self.rescan) - time.monotonic()))
+
+    def __submit(self, file):
+        with self.__lock:
+            if file in self.__busy:
+                # Check it again once the current read finishes so the change isn't lost
+                self.__pending.add(file)
+                return
+            self.__busy.add(file)
+        self.__pool.submit(self.__check, file)
+
+    def __check(self, file):
+        """
+        Read a changed file, compare it with its last read and queue any changes
+        :param file: File to check
+        """
+        reader = self.__readers[file]
+        watcher = self.__watchers[file]
+        newSave = None
+        invalid = False
+        initial = False
+        sink = metrics.sink
+        start = time.perf_counter() if sink is not None else 0
+        try:
+            data = watcher.read()
+            lastData = self.__buffers.get(file)
+            if data is None and watcher.invalid:
+                # Too short to be a save. The watcher leaves it alone until it changes
+                changes = {}
+                invalid = True
+                if sink is not None:
+                    sink.count("monitor_invalid_reads_total")
+            elif data is None:
+                # Rewritten without touching any known location, so there is nothing to decode
+                changes = {}
+                if sink is not None:
+                    sink.count("monitor_skipped_decodes_total")
+            elif lastData is None:
+                # Only kept as the baseline later reads are compared with
+                newSave = reader.decodeBuffer(data, Save())
+                changes = {}
+                initial = True
+            else:
+                # Unchanged files cost one byte comparison per field, changed ones only decode what changed
+                changes = reader.compareBuffers(data, lastData)
+                if changes:
+                    newSave = copy.copy(reader.save)
+                    for change in changes:
+                        newSave.__setattr__(change, changes[change][1])
+            if newSave is not None:
+                reader.save = newSave
+            if data is not None:
+                self.__buffers[file] = data
+                if sink is not None:
+                    sink.count("monitor_bytes_read_total", len(data))
+        except (OSError, struct.error):
+            changes = {}
+        finally:
+            with self.__lock:
+                self.__busy.discard(file)
+                again = file in self.__pending
+                self.__pending.discard(file)
+        if sink is not None:
+            sink.observe("monitor_check_seconds", time.perf_counter() - start)
+            if changes:
+                self.__observeLatency(sink, file)
+            elif not invalid and not initial:
+                sink.count("monitor_unchanged_reads_total")
+        if changes or initial:
+            self.__events.put(MonitorEvent(file, changes, newSave, time.time(), data, initial))
+        if again and not self.__stop.is_set():
+            self.__submit(file)
+
+    @staticmethod
+    def __observeLatency(sink: "metrics.MemorySink", file):
+        """
+        Record how long after the file was written its change was found
+        :param sink: Sink to record into
+        :param file: Changed file
+        """
+        try:
+            sink.observe("monitor_change_latency_seconds", max(0.0, time.time() - os.stat(file).st_mtime))
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    import sys
+    from util.notify import Notifier
+
+    metrics.fromEnvironment()
+    monitorPaths = sys.argv[1:] or [f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\']
+    # Ring the terminal bell for the same changes the GUI alerts on by default
+    with Monitor(monitorPaths) as saveMonitor, Notifier() as notifier:
+        try:
+            for event in saveMonitor.events():
+                for change in event.changes:
+                    print(f'{os.path.basename(event.path)} - {change.capitalize()}: '
+                          f'{event.changes[change][0]} -> {event.changes[change][1]}')
+                if {"deathcounter", "chapterId", "sceneId"} & set(event.changes):
+                    notifier.notify(os.path.basename(event.path))
+        except KeyboardInterrupt:
+            print("Exited")
@@ -1,26 +1,76 @@
 """Reader class and functions for reading values from a save file"""
+import itertools
 import os
+import struct
 import time
-from typing import Optional, List, Union, Dict, Tuple, Any, NoReturn
+from typing import Optional, List, Union, Dict, Tuple, Any, NoReturn, Iterable, Iterator, TYPE_CHECKING
 
-from util.locations import locations
+from util import metrics
+from util.layouts import Layout
 from util.save import Save
 
+# Threading, asyncio and the file watcher are only imported when first used, as most scripts just read a file or two
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
 
 class Reader:
     """
     Reader class to handle data reading
     """
-    def __init__(self, save: Optional[Save] = None):
-        self.save = save if save else Save()
+    def __init__(self, save: Optional[Save] = None, layout: Optional[Layout] = None):
+        """
+        :param save: Save to store read data in. Ignore to make a new one
+        :param layout: Layout of the game version being read. Ignore to pick each save's layout from its version
+        """
+        # The layout registry is only built once the first reader or writer is made
+        from util.layouts import detector
+        self.layout = layout if layout else detector.registry.default
+        self.save = save if save else Save(self.layout)
         self.lastFile = ""
-        self.__locations = locations
+        self.__detector = None if layout else detector
 
-    def readFile(self, file, saveOverride: Optional[Save] = None) -> Save:
+    def readFile(self, file, saveOverride: Optional[Save] = None, consistent: bool = False) -> Save:
         """
         Read the given file and save the data
         :param file: File to open and store data from
         :param saveOverride: Override for where data is stored from
+        :param consistent: Whether to retry reads torn by the game writing the file. See readBuffer
+        :return: Save data
+        """
+        sink = metrics.sink
+        if sink is None:
+            return self.decodeBuffer(self.readBuffer(file, consistent), saveOverride)
+        start = time.perf_counter()
+        save = self.decodeBuffer(self.readBuffer(file, consistent), saveOverride)
+        sink.observe("reader_read_seconds", time.perf_counter() - start)
+        return save
+
+    def readFileInBackground(self, file, saveOverride: Optional[Save] = None) -> "Future":
+        """
+        Read the given file and save the data on the shared I/O thread
+        :param file: File to open and store data from
+        :param saveOverride: Override for where data is stored from
+        :return: Future for the save data
+        """
+        from util import background
+        return background.submit(self.readFile, file, saveOverride)
+
+    async def readFileAsync(self, file, saveOverride: Optional[Save] = None) -> Save:
+        """
+        Read the given file and save the data without blocking the event loop
+        :param file: File to open and store data from
+        :param saveOverride: Override for where data is stored from
+        :return: Save data
+        """
+        import asyncio
+        return await asyncio.wrap_future(self.readFileInBackground(file, saveOverride))
+
+    def decodeBuffer(self, data: bytes, saveOverride: Optional[Save] = None) -> Save:
+        """
+        Decode raw save data and save the values
+        :param data: Raw save data covering every known location
+        :param saveOverride: Override for where data is stored from
         :return: Save data
         """
         if saveOverride:
@@ -28,16 +78,178 @@ class Reader:
         else:
             saveObject = self.save
 
-        savefile = open(file, "rb")
-        for location in self.__locations:
-            savefile.seek(location[0])
-            data = ""
-            for i in range(location[1]):
-                data += savefile.read(1).hex()
-            saveObject.set(location[0], data)
-        savefile.close()
+        layout = self.layoutOf(data)
+        saveObject.layout = layout
+        # Every value is sliced out of the one buffer without copying
+        return layout.codec.decodeInto(memoryview(data), saveObject)
+
+    def layoutOf(self, data: bytes, file=None) -> Layout:
+        """
+        Get the layout raw save data is decoded with
+        :param data: Raw save data
+        :param file: Optional file the data was read from, so it is read with the right length next time
+        :return: The layout of the save's version, or the reader's layout if it was given one
+        """
+        if self.__detector is None:
+            return self.layout
+        return self.__detector.detect(data, file)
+
+    def readBuffer(self, file, consistent: bool = False) -> bytes:
+        """
+        Read the raw data covering every known location from the given file without decoding it
+        :param file: File to open and read from
+        :param consistent: Whether to check the file didn't change during the read, retrying with backoff if it did.
+        Raises TornReadError if it never stops changing, or ShortFileError if it is too short to be a save
+        :return: Raw save data
+        """
+        data = self.__read(file, consistent)
         self.lastFile = file
-        return saveObject
+        if metrics.sink is not None:
+            self.__countRead(data)
+        return data
+
+    def __read(self, file, consistent: bool = False) -> bytes:
+        """
+        Read the raw data covering every known location of the file's layout
+        :param file: File to open and read from
+        :param consistent: Whether to retry reads torn by the game writing the file
+        :return: Raw save data
+        """
+        if self.__detector is None:
+            length = minLength = self.layout.end
+        else:
+            # The layout isn't known until the version is read, so short reads are checked once it is
+            length, minLength = self.__detector.readLength(file), 0
+        if consistent:
+            from util.consistent import readConsistent
+            data = readConsistent(file, length, minLength)
+        else:
+            with open(file, "rb") as savefile:
+                data = savefile.read(length)
+        if self.__detector is not None:
+            end = self.__detector.detect(data, file).end
+            if length < end:
+                # The file changed to a version with a longer layout since it was last read
+                return self.__read(file, consistent)
+            if consistent and len(data) < end:
+                data = readConsistent(file, end, end)
+        return data
+
+    def readMany(self, files: Iterable[str], workers: Optional[int] = None, ordered: bool = True,
+                 errors: str = "raise", chunk: int = 16) -> Iterator[Tuple[str, Union[Save, Exception]]]:
+        """
+        Read and decode many files concurrently, yielding each one as it is ready.
+        Doesn't touch the stored save or lastFile.
+        :param files: Files to open and store data from
+        :param workers: Maximum threads reading files at once. 1 reads them all on the calling thread
+        :param ordered: Whether to yield results in the same order as the files. Ignore to yield them as they finish
+        :param errors: What to do with a file that is missing or can't be decoded. "raise" to stop with its error,
+        "skip" to leave it out, or "yield" to yield its error in place of its save data
+        :param chunk: Files each thread reads in one go, so the cost of handing work to a thread is shared out
+        :return: Iterator of (file, save data or error)
+        """
+        if errors not in ("raise", "skip", "yield"):
+            raise ValueError("Invalid errors option: " + str(errors))
+        # Decoding holds the GIL, so more threads than cores only help files on slow drives, which can ask for them
+        workers = workers or min(8, os.cpu_count() or 1)
+        if workers == 1:
+            for file in files:
+                yield from self.__results([self.__readOne(file)], errors)
+            return
+        import queue
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        files = iter(files)
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reader")
+        # Chunks in submission order, or finished chunks in the order they finished
+        pending = deque()
+        finished: "queue.SimpleQueue[Future]" = queue.SimpleQueue()
+        inFlight = 0
+
+        def submit() -> bool:
+            batch = list(itertools.islice(files, chunk))
+            if not batch:
+                return False
+            future = pool.submit(self.__readChunk, batch)
+            if ordered:
+                pending.append(future)
+            else:
+                future.add_done_callback(finished.put)
+            return True
+
+        try:
+            # Only a few chunks per thread are queued at once so huge archives aren't all held in memory
+            while inFlight < workers * 2 and submit():
+                inFlight += 1
+            while inFlight:
+                done = pending.popleft() if ordered else finished.get()
+                inFlight -= 1
+                if submit():
+                    inFlight += 1
+                yield from self.__results(done.result(), errors)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def __readChunk(self, files: List[str]) -> List[Tuple[str, Union[Save, Exception]]]:
+        return [self.__readOne(file) for file in files]
+
+    @staticmethod
+    def __results(results: List[Tuple[str, Union[Save, Exception]]], errors: str) \
+            -> Iterator[Tuple[str, Union[Save, Exception]]]:
+        """
+        Hand read results on, dealing with failed files as readMany was asked to
+        :param results: (file, save data or error) of each file read
+        :param errors: "raise", "skip" or "yield", see readMany
+        :return: Iterator of (file, save data or error)
+        """
+        for file, save in results:
+            if isinstance(save, Exception):
+                if errors == "raise":
+                    raise save
+                if errors == "skip":
+                    continue
+            yield file, save
+
+    def __readOne(self, file) -> Tuple[str, Union[Save, Exception]]:
+        """
+        Read a file into a new save without touching the reader's state
+        :param file: File to open and store data from
+        :return: (file, save data, or the error if it is missing or can't be decoded)
+        """
+        try:
+            data = self.__read(file)
+            if metrics.sink is not None:
+                self.__countRead(data)
+            return file, self.decodeBuffer(data, Save(self.layout))
+        except (OSError, ValueError, struct.error) as error:
+            return file, error
+
+    @staticmethod
+    def __countRead(data: bytes):
+        metrics.sink.count("reader_bytes_read_total", len(data))
+
+    def compareBuffers(self, new: bytes, old: bytes) -> Dict[str, Tuple[Any, Any]]:
+        """
+        Compare two raw save buffers, only decoding the values whose bytes changed.
+        :param new: New raw save data
+        :param old: Old raw save data
+        :return: Dict of changes {change: (old, new)}
+        """
+        sink = metrics.sink
+        if sink is None:
+            return self.__diffBuffers(new, old)
+        start = time.perf_counter()
+        changes = self.__diffBuffers(new, old)
+        sink.observe("reader_compare_buffers_seconds", time.perf_counter() - start)
+        return changes
+
+    def __diffBuffers(self, new: bytes, old: bytes) -> Dict[str, Tuple[Any, Any]]:
+        layout = self.layoutOf(new)
+        oldLayout = self.layoutOf(old)
+        if oldLayout is layout:
+            return layout.codec.diff(old, new)
+        # Saves from different game versions are compared value by value
+        return self.__compareAny(self.decodeBuffer(new, Save(layout)), self.decodeBuffer(old, Save(oldLayout)))
 
     def _compare(self, new: Save, old: Optional[Save] = None) -> List[str]:
         """
@@ -46,25 +258,10 @@ class Reader:
         :param old: Old save file to compare to. Ignore to use stored save.
         :return: Changed attributes
         """
-        changed = []
         if not old:
             old = self.save
-        if old.timestamp != new.timestamp:
-            changed.append("timestamp")
-        if old.version != new.version:
-            changed.append("version")
-        if old.elapsed != new.elapsed:
-            changed.append("elapsed")
-        if old.deathcounter != new.deathcounter:
-            changed.append("deathcounter")
-        if old.slot != new.slot:
-            changed.append("slot")
-        if old.chapterId != new.chapterId:
-            changed.append("chapterId")
-        if old.sceneId != new.sceneId:
-            changed.append("sceneId")
-        if old.position != new.position:
-            changed.append("position")
+        names = new.layout.names if old.layout is new.layout else dict.fromkeys(old.layout.names + new.layout.names)
+        changed = [name for name in names if old.__getattribute__(name) != new.__getattribute__(name)]
         return changed
 
     def compare(self, new: Union[str, Save], old: Optional[Union[str, Save]] = None) \
@@ -75,15 +272,29 @@ class Reader:
         :param old: File or save object. Ignore to use stored save.
         :return: Dict of changes {change: (old, new)}
         """
+        sink = metrics.sink
+        if sink is None:
+            return self.__compareAny(new, old)
+        start = time.perf_counter()
+        changes = self.__compareAny(new, old)
+        sink.observe("reader_compare_seconds", time.perf_counter() - start)
+        return changes
+
+    def __compareAny(self, new: Union[str, Save], old: Optional[Union[str, Save]] = None) \
+            -> Dict[str, Tuple[Any, Any]]:
+        if type(new) == str and type(old) == str:
+            # The old file is read first so lastFile is left on the new one
+            oldData = self.readBuffer(old)
+            return self.compareBuffers(self.readBuffer(new), oldData)
         if not old:
             oldSave = self.save
         elif type(old) == str:
-            oldSave = Save()
+            oldSave = Save(self.layout)
             oldSave = self.readFile(old, oldSave)
         else:
             oldSave = old
         if type(new) == str:
-            newSave = Save()
+            newSave = Save(self.layout)
             newSave = self.readFile(new, newSave)
         else:
             newSave = new
@@ -102,26 +313,54 @@ class Reader:
 
     def _constantCompare(self) -> NoReturn:
         """
-        Constantly compare the current file with the last every 10 seconds.
+        Constantly compare the current file with the last whenever it changes.
         """
         ignoreTime = input("Would you like to ignore the time values?\n(Timestamp, Elapsed)\n(y/n) >>> ")
         while ignoreTime != "y" and ignoreTime != "n":
             ignoreTime = input("Would you like to ignore the time values?\n(Timestamp, Elapsed)\n(y/n) >>> ")
-        slot = input("Which slot would you like to monitor?\n(1/2/3) >>> ")
+        slot = input("Which slot would you like to monitor?\n(1/2/3/all) >>> ")
+        if slot == "all":
+            self._constantCompareAll(ignoreTime == "y")
         while not slot.isdigit() and (1 > int(slot) or int(slot) > 3):
             slot = int(input("Which slot would you like to monitor?\n(1/2/3) >>> "))
         slot = str(int(slot)-1)
         saveLocation = f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\slot_{slot}.sav'
-        save = self.readFile(saveLocation)
+        lastData = self.readBuffer(saveLocation, True)
+        save = self.decodeBuffer(lastData)
         slot = int(slot)
         if save.slot != slot:
             print("Chosen slot does not align with save's stored slot. This may cause artefacts such as no updates.")
+        from util.watcher import SaveWatcher
+        with SaveWatcher(saveLocation) as watcher:
+            self.__watchSlot(watcher, lastData, ignoreTime == "y")
+
+    def __watchSlot(self, watcher, lastData: bytes, ignoreTime: bool) -> NoReturn:
+        """
+        Print the changes to one slot whenever its watcher reports them
+        :param watcher: SaveWatcher of the slot
+        :param lastData: Raw save data the slot was last read with
+        :param ignoreTime: Whether to ignore the time values
+        """
+        watcher.poll()
         while True:
             try:
-                newSave = Save()
-                save = self.readFile(saveLocation, newSave)
-                changes = self.compare(save)
-                if ignoreTime == "y":
+                # The file is only read once its stats change, and only handed back once a known location changes
+                data = watcher.wait(1)
+                if data is None:
+                    if metrics.sink is not None:
+                        metrics.sink.count("reader_polls_total")
+                        metrics.sink.count("reader_idle_polls_total")
+                    continue
+                # Only the values whose bytes changed are decoded, straight into the stored save
+                changes = self.compareBuffers(data, lastData)
+                for change in changes:
+                    self.save.__setattr__(change, changes[change][1])
+                lastData = data
+                if metrics.sink is not None:
+                    metrics.sink.count("reader_polls_total")
+                    if not changes:
+                        metrics.sink.count("reader_idle_polls_total")
+                if ignoreTime:
                     if "elapsed" in changes:
                         changes.pop("elapsed")
                     if "timestamp" in changes:
@@ -131,12 +370,34 @@ class Reader:
                         print(f'{change.capitalize()}: {changes[change][0]} -> {changes[change][1]}')
                 else:
                     print("No changes")
-                self.save = newSave
-                time.sleep(10)
             except KeyboardInterrupt:
                 print("Exited")
                 quit(0)
 
+    def _constantCompareAll(self, ignoreTime: bool) -> NoReturn:
+        """
+        Constantly compare every slot at once, printing changes from all of them as they happen.
+        :param ignoreTime: Whether to ignore the time values
+        """
+        # Imported here as the monitor itself is built on the reader
+        from monitor import Monitor
+
+        saveLocations = [f'{os.getenv("APPDATA")}\\..\\LocalLow\\Wishfully\\Planet of Lana\\slot_{slot}.sav'
+                         for slot in range(3)]
+        with Monitor(saveLocations) as saveMonitor:
+            try:
+                for event in saveMonitor.events():
+                    changes = event.changes
+                    if ignoreTime:
+                        changes.pop("elapsed", None)
+                        changes.pop("timestamp", None)
+                    slot = os.path.basename(event.path)
+                    for change in changes:
+                        print(f'{slot} - {change.capitalize()}: {changes[change][0]} -> {changes[change][1]}')
+            except KeyboardInterrupt:
+                print("Exited")
+        quit(0)
+
 
 if __name__ == "__main__":
     if os.path.exists("test.sav"):
@@ -144,6 +405,23 @@ if __name__ == "__main__":
         testSave = reader.readFile("test.sav")
         assert testSave.deathcounter == 1, \
             "read file death fail. Got "+str(testSave.deathcounter)+" instead"
+        testChanges = reader.compare("test.sav", os.path.abspath("test.sav"))
+        assert testChanges == {} and reader.lastFile == "test.sav", \
+            "compare files fail. Got " + str(reader.lastFile) + " instead"
+        testFiles = ["test.sav", "missing.sav", "test.sav"]
+        testResults = list(reader.readMany(testFiles, 2, errors="yield", chunk=2))
+        assert [file for file, _ in testResults] == testFiles and isinstance(testResults[1][1], FileNotFoundError) \
+            and testResults[2][1].deathcounter == 1, "read many yield fail. Got " + str(testResults) + " instead"
+        testResults = list(reader.readMany(testFiles, 4, ordered=False, errors="skip", chunk=1))
+        assert [file for file, _ in testResults] == ["test.sav", "test.sav"], \
+            "read many skip fail. Got " + str(testResults) + " instead"
+        testResults = []
+        try:
+            testResults.extend(reader.readMany(testFiles, 1))
+            assert False, "read many raise fail"
+        except FileNotFoundError:
+            assert [file for file, _ in testResults] == ["test.sav"], \
+                "read many raise fail. Got " + str(testResults) + " instead"
         print("all tests passed successfully")
         del reader
 
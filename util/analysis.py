@@ -0,0 +1,256 @@
+"""Vectorised analysis of many saves at once using NumPy structured arrays. Needs numpy installed"""
+from typing import List, Tuple, Dict, Iterable, Union, Optional
+
+import numpy as np
+
+from util.archive import Archive
+from util.layouts import Field, Layout, layouts, detector
+
+
+def _format(field: Field):
+    """
+    Get the NumPy format of a field
+    :param field: Field to convert
+    :return: NumPy format
+    """
+    if field.type == int and field.length in (1, 2, 4, 8):
+        return f'<u{field.length}'
+    elif field.type == int:
+        return np.uint8, (field.length,)
+    elif field.type == str:
+        return f'S{field.length}'
+    elif field.type == list:
+        return "<u2", (3,)
+    raise TypeError("Invalid location type: " + str(field.type))
+
+
+def saveDtype(layout: Optional[Layout] = None, start: Optional[int] = None, itemsize: Optional[int] = None) \
+        -> np.dtype:
+    """
+    Get the structured dtype of a layout's known locations
+    :param layout: Layout to describe. Ignore to use the default layout
+    :param start: Offset in a save each record starts at. Ignore to start at the layout's first location
+    :param itemsize: Bytes in each record. Ignore to end at the end of the layout's last location
+    :return: Structured dtype
+    """
+    layout = layout if layout else layouts.default
+    start = layout.start if start is None else start
+    return np.dtype({
+        "names": [field.name for field in layout.fields],
+        "formats": [_format(field) for field in layout.fields],
+        "offsets": [field.offset - start for field in layout.fields],
+        "itemsize": layout.end - start if itemsize is None else itemsize,
+    })
+
+
+def fromBuffers(buffers: Iterable[Union[bytes, bytearray, memoryview]], layout: Optional[Layout] = None) \
+        -> np.ndarray:
+    """
+    Load raw save data that is already in memory, e.g. from a snapshot store.
+    Raises ValueError for any save of another layout, as one array can only hold one layout's values
+    :param buffers: Raw save data, each long enough to hold every known location of its layout
+    :param layout: Layout of the saves. Ignore to use the layout of the first save
+    :return: Structured array with one record per save
+    """
+    spans = []
+    for buffer in buffers:
+        bufferLayout = detector.detect(buffer)
+        if layout is None:
+            layout = bufferLayout
+        if bufferLayout is not layout:
+            raise ValueError(f'Save of version {bufferLayout.version} is not in the layout of version '
+                             f'{layout.version}')
+        spans.append(bytes(buffer[layout.start:layout.end]))
+    return np.frombuffer(b"".join(spans), dtype=saveDtype(layout))
+
+
+def fromArchive(archive: Archive, layout: Optional[Layout] = None) -> np.ndarray:
+    """
+    View the record table of a packed archive as a structured array. It is only copied if the archive also holds
+    saves of other layouts, which are left out
+    :param archive: Open archive. The array must be dropped before the archive is closed
+    :param layout: Layout of the saves to load. Ignore to use the layout of the first save
+    :return: Structured array with one record per save of the layout
+    """
+    if layout is None:
+        layout = archive.layout(0) if len(archive) else layouts.default
+    records = np.frombuffer(archive.records, dtype=saveDtype(layout, archive.start, archive.stride))
+    layoutIds = np.frombuffer(archive.layoutIds, dtype=np.uint16)
+    matches = layoutIds == archive.layouts.index(layout)
+    return records if matches.all() else records[matches]
+
+
+def loadSaves(files: Iterable[str], layout: Optional[Layout] = None) -> Tuple[List[str], np.ndarray]:
+    """
+    Read the known locations of many save files straight into one structured array
+    :param files: Save files to read. Files of another layout, or too short to hold every location, are skipped
+    :param layout: Layout of the saves to load. Ignore to use the layout of the first save
+    :return: (files that were loaded, structured array with one record per file)
+    """
+    files = list(files)
+    raw = None
+    loaded = []
+    for file in files:
+        try:
+            with open(file, "rb") as savefile:
+                data = savefile.read(detector.readLength(file))
+                fileLayout = detector.detect(data, file)
+                if len(data) < fileLayout.end:
+                    data += savefile.read(fileLayout.end - len(data))
+        except OSError:
+            continue
+        if layout is None and len(data) >= fileLayout.end:
+            layout = fileLayout
+        if fileLayout is not layout or len(data) < layout.end:
+            continue
+        if raw is None:
+            raw = np.empty((len(files), layout.end - layout.start), dtype=np.uint8)
+        raw[len(loaded)] = np.frombuffer(data, dtype=np.uint8, count=layout.end - layout.start, offset=layout.start)
+        loaded.append(file)
+    if raw is None:
+        return loaded, np.empty(0, dtype=saveDtype(layout))
+    return loaded, raw[:len(loaded)].reshape(-1).view(saveDtype(layout))
+
+
+def values(records: np.ndarray, name: str) -> np.ndarray:
+    """
+    Get a value from every record, converting odd length ints and strings into normal arrays
+    :param records: Structured save array
+    :param name: Value name
+    :return: Array of values
+    """
+    column = records[name]
+    if column.dtype == np.uint8 and column.ndim == 2:
+        shifts = np.arange(column.shape[1], dtype=np.uint64) * np.uint64(8)
+        return np.bitwise_or.reduce(column.astype(np.uint64) << shifts, axis=1)
+    if column.dtype.kind == "S":
+        return np.char.decode(column, "latin-1")
+    return column
+
+
+def positions(records: np.ndarray) -> np.ndarray:
+    """
+    Get the position of every record
+    :param records: Structured save array
+    :return: (N, 3) array of positions
+    """
+    return records["position"].astype(np.int64)
+
+
+def deltas(records: np.ndarray, name: str) -> np.ndarray:
+    """
+    Get the change in a value between each record and the one before it
+    :param records: Structured save array in time order
+    :param name: Value name
+    :return: Array of N - 1 signed differences
+    """
+    return np.diff(values(records, name).astype(np.int64), axis=0)
+
+
+def trajectories(records: np.ndarray) -> Dict[Tuple[int, int], np.ndarray]:
+    """
+    Split the positions into one trajectory per chapter and scene
+    :param records: Structured save array in time order
+    :return: Dict of {(chapterId, sceneId): (M, 3) positions}
+    """
+    keys = np.stack([records["chapterId"].astype(np.int64), records["sceneId"].astype(np.int64)], axis=1)
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    splits = np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1]
+    groups = np.split(positions(records)[order], splits)
+    return {(int(chapter), int(scene)): group for (chapter, scene), group in zip(unique, groups)}
+
+
+def distanceTravelled(records: np.ndarray) -> np.ndarray:
+    """
+    Get the straight line distance moved between each record and the one before it
+    :param records: Structured save array in time order
+    :return: Array of N - 1 distances
+    """
+    return np.linalg.norm(np.diff(positions(records), axis=0), axis=1)
+
+
+def elapsedPerChapter(records: np.ndarray) -> Dict[int, Dict[str, float]]:
+    """
+    Get elapsed time statistics for each chapter. Time between two records counts towards the chapter of the first
+    :param records: Structured save array in time order
+    :return: Dict of {chapterId: {snapshots, first, last, mean, spent}}
+    """
+    elapsed = values(records, "elapsed").astype(np.int64)
+    chapters, inverse = np.unique(records["chapterId"], return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse, minlength=len(chapters))
+    first = np.full(len(chapters), np.iinfo(np.int64).max)
+    last = np.full(len(chapters), np.iinfo(np.int64).min)
+    np.minimum.at(first, inverse, elapsed)
+    np.maximum.at(last, inverse, elapsed)
+    mean = np.bincount(inverse, weights=elapsed, minlength=len(chapters)) / np.maximum(counts, 1)
+    spent = np.bincount(inverse[:-1], weights=np.clip(np.diff(elapsed), 0, None), minlength=len(chapters))
+    return {int(chapter): {"snapshots": int(counts[i]), "first": int(first[i]), "last": int(last[i]),
+                           "mean": float(mean[i]), "spent": float(spent[i])}
+            for i, chapter in enumerate(chapters)}
+
+
+if __name__ == "__main__":
+    import tempfile
+    import os
+    from util.archive import ArchiveWriter
+
+    testFields = layouts.default.fieldsByName
+    testBuffers = []
+    for testChapter, testElapsed, testPosition in [(5, 10, (0, 0, 0)), (5, 40, (3, 4, 0)), (14, 100, (3, 4, 0))]:
+        testBuffer = bytearray(layouts.default.end)
+        for testName, testValue in (("chapterId", testChapter), ("elapsed", testElapsed)):
+            testField = testFields[testName]
+            testBuffer[testField.offset:testField.offset + testField.length] = \
+                testValue.to_bytes(testField.length, "little")
+        testField = testFields["position"]
+        testBuffer[testField.offset:testField.offset + 6] = b"".join(val.to_bytes(2, "little") for val in testPosition)
+        testBuffers.append(bytes(testBuffer))
+
+    testRecords = fromBuffers(testBuffers)
+    assert list(deltas(testRecords, "elapsed")) == [30, 60], \
+        "analysis deltas fail. Got " + str(deltas(testRecords, "elapsed")) + " instead"
+    assert list(distanceTravelled(testRecords)) == [5.0, 0.0], \
+        "analysis distance fail. Got " + str(distanceTravelled(testRecords)) + " instead"
+    assert elapsedPerChapter(testRecords)[5]["spent"] == 90, \
+        "analysis chapter time fail. Got " + str(elapsedPerChapter(testRecords)) + " instead"
+    assert len(trajectories(testRecords)) == len({(5, 0), (14, 0)}), \
+        "analysis trajectories fail. Got " + str(trajectories(testRecords)) + " instead"
+
+    # A newer game version keeping its death counter after the default layout's locations
+    testVersionField = testFields["version"]
+    testVersion = "9" * testVersionField.length
+    testLayout = Layout(testVersion, [(testVersionField.offset, testVersionField.length, "version", str),
+                                      (layouts.default.end, 4, "deathcounter", int)])
+    layouts.register(testLayout)
+    detector.forget()
+    testNewBuffer = bytearray(layouts.default.end + 4)
+    testNewBuffer[testVersionField.offset:testVersionField.offset + testVersionField.length] = testVersion.encode()
+    testNewBuffer[layouts.default.end] = 7
+    try:
+        fromBuffers(testBuffers + [testNewBuffer])
+        assert False, "analysis mixed layout fail"
+    except ValueError:
+        pass
+    assert list(fromBuffers([testNewBuffer])["deathcounter"]) == [7], "analysis version layout fail"
+
+    with tempfile.TemporaryDirectory() as testDirectory:
+        testFiles = []
+        for i, testBuffer in enumerate(testBuffers + [b"short", testNewBuffer]):
+            testFiles.append(os.path.join(testDirectory, f'{i}.sav'))
+            with open(testFiles[-1], "wb") as testSave:
+                testSave.write(testBuffer)
+        testLoaded, testFileRecords = loadSaves(testFiles)
+        assert testLoaded == testFiles[:3] and (testFileRecords == testRecords).all(), "analysis file load fail"
+        assert loadSaves(testFiles, testLayout)[0] == testFiles[4:], "analysis file layout fail"
+
+        with ArchiveWriter(os.path.join(testDirectory, "test.pola")) as testWriter:
+            for testBuffer in testBuffers + [testNewBuffer]:
+                testWriter.add(testBuffer)
+        with Archive(os.path.join(testDirectory, "test.pola")) as testArchive:
+            assert (fromArchive(testArchive) == testRecords).all(), "analysis archive load fail"
+            assert list(fromArchive(testArchive, testLayout)["deathcounter"]) == [7], "analysis archive layout fail"
+
+    print("All tests passed successfully")
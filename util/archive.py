@@ -0,0 +1,293 @@
+"""Packed archive format for keeping many saves in one memory mapped file"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from typing import Optional, Union, Iterator, Tuple
+
+from util.codec import LayoutCodec
+from util.layouts import Layout, detector
+from util.save import Save
+
+# Archive layout, all little endian:
+#     Header      magic, format version, flags, record count, record stride, record start offset in a save,
+#                 layout hash, and the offsets of the tables below
+#     Times       count * float64 unix times
+#     Layouts     count * uint16 index of each save's layout in the registry, the default layout being 0
+#     Records     count * stride bytes, each the bytes of a save from the first known location of any layout to the
+#                 end of the last, zero padded past the end of its own layout
+#     Blob index  count * (uint64 offset, uint64 length) into the blobs, only when full saves are included
+#     Blobs       full raw saves, back to back
+_MAGIC = b"POLA"
+_VERSION = 2
+_RAW = 0x1
+_HEADER = struct.Struct("<4sHHIII16sQQQQ")
+_BLOB = struct.Struct("<QQ")
+
+
+def layoutHash() -> bytes:
+    """
+    Get a hash identifying every registered layout in order, so archives from other layouts aren't misread
+    :return: 16 byte hash
+    """
+    layout = "|".join(f'{registered.version}:' + ";".join(f'{field.offset},{field.length},{field.name},'
+                                                          f'{field.type.__name__}' for field in registered.fields)
+                      for registered in detector.registry)
+    return hashlib.sha256(layout.encode()).digest()[:16]
+
+
+def recordSpan() -> Tuple[int, int]:
+    """
+    Get the part of a save each archive record keeps, covering the known locations of every registered layout
+    :return: (start, end) offsets in a save
+    """
+    return min(layout.start for layout in detector.registry), detector.registry.end
+
+
+class ArchiveWriter:
+    """
+    ArchiveWriter class to pack saves into a new archive. Full saves are spooled to a temporary file until closed.
+    """
+
+    def __init__(self, file, raw: bool = False):
+        """
+        :param file: Archive file to create
+        :param raw: Whether to keep each full save as well as its known locations
+        """
+        self.file = file
+        self.raw = raw
+        self.__start, self.__end = recordSpan()
+        self.__layouts = {layout: i for i, layout in enumerate(detector.registry)}
+        self.__times = bytearray()
+        self.__layoutIds = bytearray()
+        self.__records = bytearray()
+        self.__blobIndex = bytearray()
+        self.__blobs = tempfile.TemporaryFile() if raw else None
+        self.__blobSize = 0
+        self.__count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        elif self.__blobs is not None:
+            self.__blobs.close()
+
+    def add(self, data: Union[bytes, bytearray, memoryview], when: float = 0.0):
+        """
+        Add a save to the archive
+        :param data: Full raw save data, long enough to hold every known location of its layout
+        :param when: Unix time of the save
+        """
+        layout = detector.detect(data)
+        if len(data) < layout.end:
+            raise ValueError(f'Save data too short to hold every known location: {len(data)} < {layout.end}')
+        record = data[self.__start:self.__end]
+        self.__times += struct.pack("<d", when)
+        self.__layoutIds += struct.pack("<H", self.__layouts[layout])
+        self.__records += record
+        self.__records += bytes(self.__end - self.__start - len(record))
+        if self.__blobs is not None:
+            self.__blobIndex += _BLOB.pack(self.__blobSize, len(data))
+            self.__blobs.write(data)
+            self.__blobSize += len(data)
+        self.__count += 1
+
+    def addFile(self, file, when: Optional[float] = None):
+        """
+        Add a save file to the archive
+        :param file: Save file to add
+        :param when: Unix time of the save. Ignore to use the file's modification time
+        """
+        with open(file, "rb") as savefile:
+            data = savefile.read() if self.raw else savefile.read(self.__end)
+        self.add(data, os.path.getmtime(file) if when is None else when)
+
+    def close(self):
+        """
+        Write the archive out
+        """
+        timesOffset = _HEADER.size
+        layoutsOffset = timesOffset + len(self.__times)
+        recordsOffset = layoutsOffset + len(self.__layoutIds)
+        blobIndexOffset = recordsOffset + len(self.__records) if self.__blobs is not None else 0
+        header = _HEADER.pack(_MAGIC, _VERSION, _RAW if self.__blobs is not None else 0, self.__count,
+                              self.__end - self.__start, self.__start, layoutHash(), timesOffset, layoutsOffset,
+                              recordsOffset, blobIndexOffset)
+        with open(self.file, "wb") as archive:
+            archive.write(header)
+            archive.write(self.__times)
+            archive.write(self.__layoutIds)
+            archive.write(self.__records)
+            if self.__blobs is not None:
+                archive.write(self.__blobIndex)
+                self.__blobs.seek(0)
+                while True:
+                    chunk = self.__blobs.read(1 << 20)
+                    if not chunk:
+                        break
+                    archive.write(chunk)
+                self.__blobs.close()
+                self.__blobs = None
+
+
+class Archive:
+    """
+    Archive class giving random access to a packed archive through a single memory map
+    """
+
+    def __init__(self, file):
+        self.file = file
+        with open(file, "rb") as archive:
+            self.__map = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from("<4sH", self.__map, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self.__map.close()
+            raise ValueError("Not a save archive: " + str(file))
+        _, _, flags, self.count, self.stride, self.start, layout, timesOffset, layoutsOffset, recordsOffset, \
+            blobIndexOffset = _HEADER.unpack_from(self.__map, 0)
+        if layout != layoutHash():
+            self.__map.close()
+            raise ValueError("Archive was packed with different save locations: " + str(file))
+        self.raw = bool(flags & _RAW)
+        view = memoryview(self.__map)
+        self.times = view[timesOffset:timesOffset + self.count * 8].cast("d")
+        self.layoutIds = view[layoutsOffset:layoutsOffset + self.count * 2].cast("H")
+        self.records = view[recordsOffset:recordsOffset + self.count * self.stride]
+        self.__blobIndex = view[blobIndexOffset:blobIndexOffset + self.count * _BLOB.size] if self.raw else None
+        self.__blobsOffset = blobIndexOffset + self.count * _BLOB.size
+        self.layouts = list(detector.registry)
+        # Records start at the first known location of any layout, so each layout's codec is shifted to match
+        self.__codecs = [LayoutCodec([(field.offset - self.start, field.length, field.name, field.type)
+                                      for field in layout.fields]) for layout in self.layouts]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Tuple[float, Save]]:
+        for i in range(self.count):
+            yield self.times[i], self.save(i)
+
+    def __index(self, i: int) -> int:
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("Archive index out of range: " + str(i))
+        return i
+
+    def layout(self, i: int) -> Layout:
+        """
+        Get the layout of a save
+        :param i: Index of the save
+        :return: Layout the save was decoded with when it was added
+        """
+        return self.layouts[self.layoutIds[self.__index(i)]]
+
+    def record(self, i: int) -> memoryview:
+        """
+        Get the raw known locations of a save without copying
+        :param i: Index of the save
+        :return: stride bytes starting from the save's first known location
+        """
+        i = self.__index(i)
+        return self.records[i * self.stride:(i + 1) * self.stride]
+
+    def save(self, i: int, saveOverride: Optional[Save] = None) -> Save:
+        """
+        Decode a save
+        :param i: Index of the save
+        :param saveOverride: Override for where data is stored from
+        :return: Save data
+        """
+        layoutId = self.layoutIds[self.__index(i)]
+        saveObject = saveOverride if saveOverride else Save()
+        saveObject.layout = self.layouts[layoutId]
+        return self.__codecs[layoutId].decodeInto(self.record(i), saveObject)
+
+    def rawSave(self, i: int) -> memoryview:
+        """
+        Get the full raw save without copying, if the archive includes them
+        :param i: Index of the save
+        :return: Full raw save data
+        """
+        if not self.raw:
+            raise KeyError("Archive does not include full saves: " + str(self.file))
+        offset, length = _BLOB.unpack_from(self.__blobIndex, self.__index(i) * _BLOB.size)
+        return memoryview(self.__map)[self.__blobsOffset + offset:self.__blobsOffset + offset + length]
+
+    def close(self):
+        """
+        Close the archive. Any views taken from it must be released first
+        """
+        self.times.release()
+        self.layoutIds.release()
+        self.records.release()
+        if self.__blobIndex is not None:
+            self.__blobIndex.release()
+        self.__map.close()
+
+
+if __name__ == "__main__":
+    from util.layouts import layouts
+
+    testDefault = layouts.default
+    with tempfile.TemporaryDirectory() as testDirectory:
+        testFile = os.path.join(testDirectory, "test.pola")
+        testBuffers = [bytes([i]) * (testDefault.end + i) for i in range(3)]
+        with ArchiveWriter(testFile, raw=True) as testWriter:
+            for i, testBuffer in enumerate(testBuffers):
+                testWriter.add(testBuffer, 100 + i)
+        with Archive(testFile) as testArchive:
+            assert len(testArchive) == 3 and testArchive.times[2] == 102, "archive header fail"
+            assert testArchive.record(1)[:testDefault.end - testArchive.start] \
+                == testBuffers[1][testArchive.start:testDefault.end], "archive record fail"
+            assert testArchive.rawSave(-1) == testBuffers[2], "archive raw fail"
+            testSave = testArchive.save(0)
+            testName = testDefault.fields[0].name
+            assert testSave.__getattribute__(testName) == testDefault.codec.decode(testBuffers[0])[testName], \
+                "archive decode fail"
+
+        # A newer game version keeping its death counter after the default layout's locations
+        testVersionField = testDefault.fieldsByName["version"]
+        testVersion = "9" * testVersionField.length
+        testLayout = Layout(testVersion, [(testVersionField.offset, testVersionField.length, "version", str),
+                                          (testDefault.end, 4, "deathcounter", int)])
+        layouts.register(testLayout)
+        detector.forget()
+        try:
+            Archive(testFile)
+            assert False, "archive layout hash fail"
+        except ValueError:
+            pass
+        testOld = bytearray(testDefault.end + 4)
+        testOld[testDefault.fieldsByName["deathcounter"].offset] = 5
+        testNew = bytearray(testOld)
+        testNew[testVersionField.offset:testVersionField.offset + testVersionField.length] = testVersion.encode()
+        testNew[testDefault.end] = 7
+        with ArchiveWriter(testFile) as testWriter:
+            testWriter.add(testOld[:testDefault.end])
+            testWriter.add(testNew)
+            try:
+                testWriter.add(testNew[:testDefault.end])
+                assert False, "archive short version fail"
+            except ValueError:
+                pass
+        with Archive(testFile) as testArchive:
+            assert (testArchive.start, testArchive.start + testArchive.stride) == recordSpan() \
+                and recordSpan()[1] >= testLayout.end, \
+                "archive stride fail. Got " + str(testArchive.stride) + " instead"
+            assert testArchive.layout(0) is testDefault and testArchive.layout(1) is testLayout, "archive layout fail"
+            assert (testArchive.save(0).deathcounter, testArchive.save(1).deathcounter) == (5, 7), \
+                "archive version decode fail. Got " + str(testArchive.save(1).deathcounter) + " instead"
+            assert testArchive.save(1).layout is testLayout, "archive save layout fail"
+
+    print("All tests passed successfully")
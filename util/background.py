@@ -0,0 +1,29 @@
+"""Shared background executor for running save file I/O off the calling thread"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Optional, Any
+
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def executor() -> ThreadPoolExecutor:
+    """
+    Get the shared I/O executor, creating it on first use.
+    It has a single thread so reads and writes of the same file always happen in the order they were asked for.
+    :return: Executor
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save-io")
+        return _executor
+
+
+def submit(function: Callable[..., Any], *args, **kwargs) -> Future:
+    """
+    Run a function on the shared I/O thread
+    :param function: Function to run
+    :return: Future for the function's result
+    """
+    return executor().submit(function, *args, **kwargs)
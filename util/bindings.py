@@ -0,0 +1,148 @@
+"""Table driven binding of save values to widgets, only redrawing what changed"""
+from typing import List, Dict, Tuple, Any, Optional, Callable, NamedTuple
+
+_UNSET = object()
+
+
+class Binding(NamedTuple):
+    """
+    One widget showing one save value, or one item of a list value
+    """
+    name: str
+    widget: Any
+    format: Callable[[Any], str] = str
+    index: Optional[int] = None
+    editable: bool = False
+
+
+class Bindings:
+    """
+    Bindings class to keep widgets in step with a save. The last value and colour drawn in each widget are
+    remembered, so each render only formats and redraws the widgets whose value changed, and every render
+    requested before the window is next idle is drawn in a single callback.
+    Widgets only need Tk style item access for "text" and "fg", and get/delete/insert if editable.
+    """
+
+    def __init__(self, window, bindings: List[Binding], changed: str = "red", unchanged: str = "black"):
+        """
+        :param window: Window to schedule drawing on, anything with after_idle
+        :param bindings: Widgets to keep up to date
+        :param changed: Colour of values that changed
+        :param unchanged: Colour of values that didn't
+        """
+        self.__window = window
+        self.__bindings = bindings
+        self.__changed = changed
+        self.__unchanged = unchanged
+        self.__values: List[Any] = [_UNSET] * len(bindings)
+        self.__texts: List[Optional[str]] = [None] * len(bindings)
+        self.__colours: List[Optional[str]] = [None] * len(bindings)
+        self.__pendingValues: Dict[int, Any] = {}
+        self.__pendingColours: Dict[int, str] = {}
+        self.__scheduled = False
+
+    def render(self, save, changes: Optional[Dict[str, Tuple[Any, Any]]] = None):
+        """
+        Show a save's values, drawn once the window is idle
+        :param save: Save to show
+        :param changes: Optional changes {change: (old, new)} to colour, every other value is coloured as unchanged
+        """
+        for i, binding in enumerate(self.__bindings):
+            value = save.__getattribute__(binding.name)
+            if binding.index is not None:
+                value = _item(value, binding.index)
+            self.__pendingValues[i] = value
+        if changes is not None:
+            self.highlight(changes)
+        self.__schedule()
+
+    def highlight(self, changes: Dict[str, Tuple[Any, Any]]):
+        """
+        Colour values by whether they changed. List items are only coloured if that item changed
+        :param changes: Changes {change: (old, new)}
+        """
+        for i, binding in enumerate(self.__bindings):
+            changed = binding.name in changes
+            if changed and binding.index is not None:
+                old, new = changes[binding.name]
+                changed = _item(old, binding.index) != _item(new, binding.index)
+            self.__pendingColours[i] = self.__changed if changed else self.__unchanged
+        self.__schedule()
+
+    def flush(self):
+        """
+        Draw anything waiting to be drawn straight away
+        """
+        self.__scheduled = False
+        values, self.__pendingValues = self.__pendingValues, {}
+        colours, self.__pendingColours = self.__pendingColours, {}
+        for i, value in values.items():
+            binding = self.__bindings[i]
+            if binding.editable:
+                # Entries can be typed in, so check what they show rather than what was last drawn
+                text = binding.format(value) if value is not None else ""
+                if binding.widget.get() != text:
+                    binding.widget.delete(0, "end")
+                    binding.widget.insert(0, text)
+                self.__values[i] = value
+            elif value != self.__values[i]:
+                text = binding.format(value) if value is not None else "None"
+                if text != self.__texts[i]:
+                    binding.widget["text"] = text
+                    self.__texts[i] = text
+                self.__values[i] = value
+        for i, colour in colours.items():
+            if colour != self.__colours[i]:
+                self.__bindings[i].widget["fg"] = colour
+                self.__colours[i] = colour
+
+    def __schedule(self):
+        if not self.__scheduled:
+            self.__scheduled = True
+            self.__window.after_idle(self.flush)
+
+
+def _item(value, index: int):
+    return value[index] if value is not None and index < len(value) else None
+
+
+if __name__ == "__main__":
+    from util.save import Save
+
+    class TestWidget(dict):
+        def __init__(self):
+            super().__init__()
+            self.writes = 0
+
+        def __setitem__(self, key, value):
+            self.writes += 1
+            super().__setitem__(key, value)
+
+    class TestWindow:
+        def __init__(self):
+            self.idle = []
+
+        def after_idle(self, callback):
+            self.idle.append(callback)
+
+    testWindow = TestWindow()
+    testDeaths = TestWidget()
+    testPosition = [TestWidget() for _ in range(3)]
+    testBindings = Bindings(testWindow, [Binding("deathcounter", testDeaths)] +
+                            [Binding("position", testPosition[i], index=i) for i in range(3)])
+    testSave = Save()
+    testSave.deathcounter, testSave.position = 4, [1, 2, 3]
+    testBindings.render(testSave)
+    testBindings.render(testSave)
+    assert len(testWindow.idle) == 1, "bindings coalesce fail. Got " + str(len(testWindow.idle)) + " instead"
+    testWindow.idle.pop()()
+    assert testDeaths["text"] == "4" and testPosition[2]["text"] == "3", "bindings render fail"
+    testSave = Save()
+    testSave.deathcounter, testSave.position = 4, [1, 5, 3]
+    testBindings.render(testSave, {"position": ([1, 2, 3], [1, 5, 3])})
+    testWindow.idle.pop()()
+    assert testDeaths.writes == 2 and testPosition[0].writes == 2 and testPosition[1].writes == 3, \
+        "bindings dirty tracking fail. Got " + str([testDeaths.writes] + [w.writes for w in testPosition]) + " instead"
+    assert testPosition[1]["fg"] == "red" and testPosition[0]["fg"] == "black", "bindings highlight fail"
+
+    print("All tests passed successfully")
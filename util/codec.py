@@ -0,0 +1,191 @@
+"""Precompiled struct codec for decoding and encoding the known save locations"""
+import struct
+from typing import List, Tuple, Dict, Any, Optional, Iterable, Union, TYPE_CHECKING
+
+# Layouts compile a codec each, so this module can't import them or the saves built from them
+if TYPE_CHECKING:
+    from util.save import Save
+
+# Struct codes for ints whose length has a native struct size
+_INT_CODES = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+def convertFromBytes(val: Union[bytes, memoryview], valtype: type) -> Union[int, str, list, TypeError]:
+    """
+    Convert a raw little endian value straight from the save's bytes to str/int
+    :param val: Raw bytes of the value
+    :param valtype: What to convert to
+    :return: Int or Str conversion of the bytes
+    """
+    if valtype == int:
+        return int.from_bytes(val, "little")
+    elif valtype == str:
+        return bytes(val).decode("latin-1")
+    elif valtype == list:
+        return [int.from_bytes(val[i:i + 2], "little") for i in range(0, 6, 2)]
+    else:
+        return TypeError("Invalid conversion target type: " + str(valtype))
+
+
+class LayoutCodec:
+    """
+    Codec compiled once from a list of (offset, length, name, type) locations.
+    Neighbouring locations are merged into one struct.Struct, with the bytes between them kept as raw padding so
+    encoding never touches unknown data. Overlapping locations start a new struct.
+    """
+
+    def __init__(self, fieldLocations: List[Tuple[int, int, str, type]]):
+        self.__locations = sorted(fieldLocations, key=lambda location: location[0])
+        self.start = self.__locations[0][0] if self.__locations else 0
+        self.end = max((location[0] + location[1] for location in self.__locations), default=0)
+        # [(base offset, Struct, [(name, type, length, value index, is raw)])]
+        self.__groups: List[Tuple[int, struct.Struct, List[Tuple[str, type, int, int, bool]]]] = []
+        self.__compile()
+
+    def __compile(self):
+        group = None
+        for offset, length, name, valtype in self.__locations:
+            if group is None or offset < group["end"]:
+                if group is not None:
+                    self.__addGroup(group)
+                group = {"base": offset, "end": offset, "format": "<", "fields": [], "count": 0}
+            if offset > group["end"]:
+                group["format"] += f'{offset - group["end"]}s'
+                group["count"] += 1
+            if valtype == int and length in _INT_CODES:
+                group["fields"].append((name, valtype, length, group["count"], False))
+                group["format"] += _INT_CODES[length]
+                group["count"] += 1
+            elif valtype == list:
+                if length != 6:
+                    raise ValueError("List locations must be 3 shorts long: " + str(name))
+                group["fields"].append((name, valtype, length, group["count"], False))
+                group["format"] += "3H"
+                group["count"] += 3
+            elif valtype in (int, str):
+                group["fields"].append((name, valtype, length, group["count"], True))
+                group["format"] += f'{length}s'
+                group["count"] += 1
+            else:
+                raise TypeError("Invalid location type: " + str(valtype))
+            group["end"] = offset + length
+        if group is not None:
+            self.__addGroup(group)
+
+    def __addGroup(self, group: Dict[str, Any]):
+        self.__groups.append((group["base"], struct.Struct(group["format"]), group["fields"]))
+
+    def decode(self, buffer: Union[bytes, bytearray, memoryview]) -> Dict[str, Any]:
+        """
+        Decode every known location out of a save buffer
+        :param buffer: Raw save data, at least self.end bytes long
+        :return: Dict of {name: value}
+        """
+        decoded = {}
+        for base, compiled, fields in self.__groups:
+            values = compiled.unpack_from(buffer, base)
+            for name, valtype, length, index, raw in fields:
+                if raw:
+                    decoded[name] = convertFromBytes(values[index], valtype)
+                elif valtype == list:
+                    decoded[name] = list(values[index:index + 3])
+                else:
+                    decoded[name] = values[index]
+        return decoded
+
+    def decodeInto(self, buffer: Union[bytes, bytearray, memoryview], save: "Save") -> "Save":
+        """
+        Decode every known location out of a save buffer into a save object
+        :param buffer: Raw save data, at least self.end bytes long
+        :param save: Save object to store the values in
+        :return: Save data
+        """
+        for name, value in self.decode(buffer).items():
+            save.__setattr__(name, value)
+        return save
+
+    def diff(self, old: Union[bytes, bytearray, memoryview], new: Union[bytes, bytearray, memoryview]) \
+            -> Dict[str, Tuple[Any, Any]]:
+        """
+        Compare two save buffers field by field, only decoding the fields whose bytes differ
+        :param old: Old raw save data
+        :param new: New raw save data
+        :return: Dict of changes {name: (old, new)}
+        """
+        old = memoryview(old)
+        new = memoryview(new)
+        changes = {}
+        for offset, length, name, valtype in self.__locations:
+            oldBytes = old[offset:offset + length]
+            newBytes = new[offset:offset + length]
+            if oldBytes != newBytes:
+                changes[name] = (convertFromBytes(oldBytes, valtype), convertFromBytes(newBytes, valtype))
+        return changes
+
+    def encodeInto(self, buffer: Union[bytearray, memoryview], save: "Save", keys: Optional[Iterable[str]] = None) \
+            -> Union[bytearray, memoryview]:
+        """
+        Encode the save's values into a writable save buffer in place
+        :param buffer: Writable raw save data, at least self.end bytes long
+        :param save: Save object to source the values from
+        :param keys: Optional names of the only values to encode
+        :return: The buffer
+        """
+        keys = set(keys) if keys is not None else None
+        for base, compiled, fields in self.__groups:
+            fields = [field for field in fields if keys is None or field[0] in keys]
+            if not fields:
+                continue
+            values = list(compiled.unpack_from(buffer, base))
+            for name, valtype, length, index, raw in fields:
+                value = save.__getattribute__(name)
+                if raw and valtype == int:
+                    values[index] = value.to_bytes(length, "little")
+                elif raw:
+                    values[index] = value.encode("latin-1")
+                elif valtype == list:
+                    values[index:index + 3] = value[:3]
+                else:
+                    values[index] = value
+            compiled.pack_into(buffer, base, *values)
+        return buffer
+
+
+def __getattr__(name: str) -> LayoutCodec:
+    # The default layout's codec, looked up on first use as util.layouts imports this module to compile it
+    if name == "codec":
+        from util.layouts import layouts
+        return layouts.default.codec
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+if __name__ == "__main__":
+    from util.save import Save
+
+    testCodec = LayoutCodec([(0, 4, "deathcounter", int), (6, 3, "version", str), (8, 6, "position", list),
+                             (16, 3, "slot", int)])
+    assert testCodec.end == 19, "codec end fail. Got " + str(testCodec.end) + " instead"
+    testBuffer = bytearray(range(20))
+    testSave = Save()
+    testCodec.decodeInto(testBuffer, testSave)
+    assert testSave.deathcounter == 0x03020100, \
+        "codec int decode fail. Got " + str(testSave.deathcounter) + " instead"
+    assert testSave.position == [0x0908, 0x0b0a, 0x0d0c], \
+        "codec overlapping list decode fail. Got " + str(testSave.position) + " instead"
+    assert testSave.slot == 0x121110, "codec odd int decode fail. Got " + str(testSave.slot) + " instead"
+
+    testSave.deathcounter = 15
+    testSave.slot = 2
+    testCodec.encodeInto(testBuffer, testSave, ["deathcounter", "slot"])
+    assert testBuffer == bytearray(b"\x0f\x00\x00\x00") + bytearray(range(4, 16)) + b"\x02\x00\x00\x13", \
+        "codec encode fail. Got " + testBuffer.hex() + " instead"
+
+    oldBuffer = bytes(testBuffer)
+    testBuffer[1] = 1
+    testBuffer[5] = 1
+    assert testCodec.diff(oldBuffer, testBuffer) == {"deathcounter": (15, 271)}, \
+        "codec diff fail. Got " + str(testCodec.diff(oldBuffer, testBuffer)) + " instead"
+    assert testCodec.diff(testBuffer, testBuffer) == {}, \
+        "codec unchanged diff fail. Got " + str(testCodec.diff(testBuffer, testBuffer)) + " instead"
+
+    print("All tests passed successfully")
@@ -0,0 +1,130 @@
+"""Consistent reads of save files that the game may be rewriting at the same time"""
+import os
+import time
+from typing import Optional, Tuple
+
+from util import metrics
+
+
+class TornReadError(OSError):
+    """
+    Raised when a file kept changing while it was read, so no consistent copy of it could be taken
+    """
+
+
+class ShortFileError(OSError):
+    """
+    Raised when a file didn't change while it was read, but is too short to hold every known location
+    """
+
+    def __init__(self, file, length: int, minLength: int, stat: os.stat_result):
+        super().__init__(f'File too short to be a save, {length} < {minLength} bytes: {file}')
+        self.stat = stat
+
+
+def _statKey(stat: os.stat_result) -> Tuple[int, int, int]:
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def readConsistentStat(file, length: Optional[int] = None, minLength: int = 0, retries: int = 5,
+                       delay: float = 0.005, double: bool = False) -> Tuple[bytes, os.stat_result]:
+    """
+    Read a file, retrying if it was written to or replaced during the read.
+    The file's (mtime_ns, size, inode) are compared before and after each attempt, and with double the data is read
+    twice and compared too, for file systems with coarse modification times. A file that didn't change during the read
+    but is shorter than minLength raises ShortFileError straight away, as retrying won't make it any longer.
+    :param file: File to read
+    :param length: Bytes to read from the start. Ignore to read the whole file
+    :param minLength: Fewest bytes a save can have
+    :param retries: Attempts after the first before giving up
+    :param delay: Seconds to wait before the first retry, doubling for each one after
+    :param double: Whether to also read the data twice and compare
+    :return: (data, stats of the file the data came from)
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(delay * 2 ** (attempt - 1))
+            if metrics.sink is not None:
+                metrics.sink.count("consistent_read_retries_total")
+        with open(file, "rb") as savefile:
+            before = os.fstat(savefile.fileno())
+            data = savefile.read() if length is None else savefile.read(length)
+            if double:
+                savefile.seek(0)
+                again = savefile.read() if length is None else savefile.read(length)
+        after = os.stat(file)
+        if _statKey(before) != _statKey(after) or (length is None and len(data) != after.st_size):
+            continue
+        if double and again != data:
+            continue
+        if len(data) < minLength:
+            raise ShortFileError(file, len(data), minLength, after)
+        return data, after
+    if metrics.sink is not None:
+        metrics.sink.count("torn_reads_total")
+    raise TornReadError(f'File kept changing while being read after {retries + 1} attempts: {file}')
+
+
+def readConsistent(file, length: Optional[int] = None, minLength: int = 0, retries: int = 5,
+                   delay: float = 0.005, double: bool = False) -> bytes:
+    """
+    Read a file, retrying if it was written to or replaced during the read. See readConsistentStat
+    :param file: File to read
+    :param length: Bytes to read from the start. Ignore to read the whole file
+    :param minLength: Fewest bytes a save can have
+    :param retries: Attempts after the first before giving up
+    :param delay: Seconds to wait before the first retry, doubling for each one after
+    :param double: Whether to also read the data twice and compare
+    :return: Data read
+    """
+    return readConsistentStat(file, length, minLength, retries, delay, double)[0]
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as testDirectory:
+        testFile = os.path.join(testDirectory, "slot_0.sav")
+        with open(testFile, "wb") as testSave:
+            testSave.write(b"\1" * 64)
+        assert readConsistent(testFile, double=True) == b"\1" * 64, "consistent read fail"
+        assert readConsistent(testFile, 16, 16) == b"\1" * 16, "consistent partial read fail"
+        testSink = metrics.enable(metrics.MemorySink())
+        try:
+            readConsistent(testFile, 128, 128, retries=2, delay=0.001)
+            assert False, "consistent read fail. Accepted a short file"
+        except ShortFileError as testError:
+            assert testError.stat.st_size == 64, "consistent short stat fail"
+        assert testSink.snapshot()["counters"] == {}, \
+            "consistent short fail. Retried a stable file " + str(testSink.snapshot()) + " instead"
+
+        # Reads the file appears to change during are tried again
+        testFstat = os.fstat
+        testChanges = [1]
+
+        def testChangingFstat(fd):
+            stat = testFstat(fd)
+            if testChanges[0] <= 0:
+                return stat
+            testChanges[0] -= 1
+            return os.stat_result((stat.st_mode, stat.st_ino, stat.st_dev, stat.st_nlink, stat.st_uid, stat.st_gid,
+                                   stat.st_size - 1, stat.st_atime, stat.st_mtime, stat.st_ctime))
+
+        os.fstat = testChangingFstat
+        try:
+            testData = readConsistent(testFile, 64, 64, retries=2, delay=0.001)
+            assert testData == b"\1" * 64, "consistent retry fail. Got " + str(testData) + " instead"
+            assert testSink.snapshot()["counters"] == {"consistent_read_retries_total": 1}, \
+                "consistent retry count fail. Got " + str(testSink.snapshot()) + " instead"
+            testChanges[0] = 10
+            try:
+                readConsistent(testFile, retries=2, delay=0.001)
+                assert False, "consistent read fail. Accepted a file that kept changing"
+            except TornReadError:
+                pass
+            assert testSink.snapshot()["counters"]["torn_reads_total"] == 1, "consistent torn count fail"
+        finally:
+            os.fstat = testFstat
+            metrics.disable()
+
+    print("All tests passed successfully")
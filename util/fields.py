@@ -0,0 +1,8 @@
+"""Known save locations of the default layout. See util.layouts for the layouts of other game versions"""
+from typing import List, Dict
+
+from util.layouts import Field, layouts
+
+fields: List[Field] = layouts.default.fields
+fieldsByOffset: Dict[int, Field] = layouts.default.fieldsByOffset
+fieldsByName: Dict[str, Field] = layouts.default.fieldsByName
@@ -0,0 +1,358 @@
+"""
+Registry of the save layout of each game version.
+Every layout is validated and compiled into its lookup tables and codec once, when it is registered, so saves from
+several game patches can be handled in one process without working out offsets again.
+Layouts come from util.locations: `locations` is the default layout, and an optional `layouts` dict of
+{version: locations} adds the layouts of other game versions. The module's `layouts` registry and `detector` are only
+built on first use, so importing the reader doesn't compile every layout.
+"""
+import keyword
+import threading
+from typing import NamedTuple, List, Dict, Tuple, Optional, Iterable, Iterator, Union
+
+from util import locations as _locations
+from util import metrics
+from util.codec import LayoutCodec
+
+# Names a save's values can't use, as Save keeps its layout under them
+_RESERVED = ("layout",)
+
+
+def mergeRanges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Merge overlapping and touching byte ranges
+    :param ranges: (offset, length) ranges
+    :return: Sorted, merged (start, end) ranges
+    """
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], offset + length))
+        else:
+            merged.append((offset, offset + length))
+    return merged
+
+
+class Field(NamedTuple):
+    """
+    Descriptor for a single known save location
+    """
+    offset: int
+    length: int
+    name: str
+    type: type
+
+
+def normaliseVersion(version: Optional[str]) -> Optional[str]:
+    """
+    Strip the padding a version string can have in a save
+    :param version: Version string as read from a save
+    :return: Version used to look layouts up, or None if there isn't one
+    """
+    if version is None:
+        return None
+    version = version.strip("\0 ")
+    return version if version else None
+
+
+class Layout:
+    """
+    Layout class holding one game version's known save locations, compiled into lookup tables and a codec
+    """
+
+    def __init__(self, version: Optional[str], fieldLocations: Iterable[Tuple[int, int, str, type]]):
+        """
+        :param version: Game version the layout is for. None for the default layout
+        :param fieldLocations: (offset, length, name, type) locations
+        """
+        self.version = normaliseVersion(version)
+        self.fields: List[Field] = [Field(*location) for location in fieldLocations]
+        self.validate()
+        self.fieldsByOffset: Dict[int, Field] = {field.offset: field for field in self.fields}
+        self.fieldsByName: Dict[str, Field] = {field.name: field for field in self.fields}
+        self.names: Tuple[str, ...] = tuple(field.name for field in self.fields)
+        self.ranges: List[Tuple[int, int]] = mergeRanges((field.offset, field.length) for field in self.fields)
+        self.codec = LayoutCodec(self.fields)
+        self.start = self.codec.start
+        self.end = self.codec.end
+
+    def validate(self):
+        """
+        Check the layout's locations can be decoded and looked up unambiguously.
+        Raises TypeError for unsupported types and ValueError for anything else
+        """
+        names = set()
+        offsets = set()
+        for offset, length, name, valtype in self.fields:
+            if not isinstance(name, str) or not name.isidentifier() or keyword.iskeyword(name) \
+                    or name.startswith("__") or name in _RESERVED:
+                raise ValueError(f'Invalid location name in layout {self.version}: {name}')
+            if name in names:
+                raise ValueError(f'Duplicate location name in layout {self.version}: {name}')
+            if offset in offsets:
+                raise ValueError(f'Duplicate location offset in layout {self.version}: {offset}')
+            if type(offset) != int or type(length) != int or offset < 0 or length <= 0:
+                raise ValueError(f'Invalid location offset or length in layout {self.version}: {name}')
+            if valtype not in (int, str, list):
+                raise TypeError(f'Invalid location type in layout {self.version}: {valtype}')
+            if valtype == list and length != 6:
+                raise ValueError(f'List locations must be 3 shorts long in layout {self.version}: {name}')
+            names.add(name)
+            offsets.add(offset)
+
+    def __reduce__(self):
+        # Saves holding a registered layout are sent to other processes by version, not by their compiled structs.
+        # Any other layout is rebuilt from its locations, as its version may mean another layout elsewhere
+        if layoutFor(self.version) is self:
+            return layoutFor, (self.version,)
+        return Layout, (self.version, [tuple(field) for field in self.fields])
+
+    def __repr__(self) -> str:
+        return f'Layout({self.version!r}, {len(self.fields)} locations)'
+
+
+class LayoutRegistry:
+    """
+    LayoutRegistry class looking up the layout of each game version, falling back to a default layout
+    """
+
+    def __init__(self, default: Layout, others: Iterable[Layout] = ()):
+        """
+        :param default: Layout for saves from versions without one of their own
+        :param others: Layouts of specific game versions
+        """
+        self.default = default
+        self.__layouts: Dict[str, Layout] = {}
+        self.names: Tuple[str, ...] = default.names
+        # Longest read any layout needs, and the (start, end) ranges the layouts keep their version string at
+        self.end = default.end
+        self.versionRanges: List[Tuple[int, int]] = []
+        for layout in others:
+            self.register(layout)
+
+    def register(self, layout: Layout):
+        """
+        Add a game version's layout. Saves can only hold values named in util.locations, see knownNames
+        :param layout: Layout to add
+        """
+        if layout.version is None:
+            raise ValueError("Only the default layout can be without a version")
+        if layout.version in self.__layouts:
+            raise ValueError("Layout already registered for version: " + layout.version)
+        self.__layouts[layout.version] = layout
+        self.names = tuple(dict.fromkeys(self.names + layout.names))
+        self.end = max(self.end, layout.end)
+        versionField = layout.fieldsByName.get("version")
+        if versionField is not None and versionField.type == str:
+            versionRange = (versionField.offset, versionField.offset + versionField.length)
+            if versionRange not in self.versionRanges:
+                self.versionRanges.append(versionRange)
+
+    def get(self, version: Optional[str], fallback: bool = True) -> Layout:
+        """
+        Get the layout of a game version
+        :param version: Version string, as read from a save or not
+        :param fallback: Whether to use the default layout for unknown versions. Raises KeyError otherwise
+        :return: The version's layout
+        """
+        layout = self.__layouts.get(normaliseVersion(version))
+        if layout is not None:
+            return layout
+        if fallback or version is None:
+            return self.default
+        raise KeyError("No layout registered for version: " + str(version))
+
+    def versions(self) -> List[str]:
+        """
+        Get every version with its own layout
+        :return: List of versions in the order they were registered
+        """
+        return list(self.__layouts)
+
+    def __contains__(self, version: Optional[str]) -> bool:
+        return normaliseVersion(version) in self.__layouts
+
+    def __iter__(self) -> Iterator[Layout]:
+        yield self.default
+        yield from self.__layouts.values()
+
+    def __len__(self) -> int:
+        return len(self.__layouts) + 1
+
+
+class LayoutDetector:
+    """
+    LayoutDetector class picking a save's layout from its version string.
+    Layouts are cached by the raw bytes at the version locations, so each distinct version is only looked up once,
+    and per file, so each file is read with its layout's length straight away
+    """
+
+    def __init__(self, registry: LayoutRegistry, maxEntries: int = 4096):
+        """
+        :param registry: Layouts to pick from
+        :param maxEntries: Most versions and files to cache before starting over
+        """
+        self.registry = registry
+        self.maxEntries = maxEntries
+        self.__byContent: Dict[bytes, Layout] = {}
+        self.__byFile: Dict[str, Layout] = {}
+
+    def detect(self, data: Union[bytes, bytearray, memoryview], file=None) -> Layout:
+        """
+        Get the layout of raw save data
+        :param data: Raw save data, starting from the beginning of the save
+        :param file: Optional file the data was read from, to remember its layout for
+        :return: The layout of the save's version, or the default layout if it has none of its own
+        """
+        if not self.registry.versionRanges:
+            return self.registry.default
+        key = b"".join(bytes(data[start:end]) for start, end in self.registry.versionRanges)
+        layout = self.__byContent.get(key)
+        if layout is None:
+            layout = self.__lookup(data)
+            if len(self.__byContent) >= self.maxEntries:
+                self.__byContent.clear()
+            self.__byContent[key] = layout
+        if file is not None and self.__byFile.get(file) is not layout:
+            if len(self.__byFile) >= self.maxEntries:
+                self.__byFile.clear()
+            self.__byFile[file] = layout
+        return layout
+
+    def readLength(self, file) -> int:
+        """
+        Get how many bytes to read from a file to cover every known location of its layout
+        :param file: File to read
+        :return: The end of the layout the file had last time, or of the longest layout for a new file
+        """
+        layout = self.__byFile.get(file)
+        return layout.end if layout is not None else self.registry.end
+
+    def forget(self):
+        """
+        Forget every cached version and file, e.g. after registering another layout
+        """
+        self.__byContent.clear()
+        self.__byFile.clear()
+
+    def __lookup(self, data: Union[bytes, bytearray, memoryview]) -> Layout:
+        if metrics.sink is not None:
+            metrics.sink.count("layout_lookups_total")
+        for start, end in self.registry.versionRanges:
+            version = bytes(data[start:end]).decode("latin-1")
+            if version in self.registry:
+                layout = self.registry.get(version)
+                # Only trust the version if the layout keeps it where it was read from
+                versionField = layout.fieldsByName["version"]
+                if (versionField.offset, versionField.offset + versionField.length) == (start, end):
+                    return layout
+        return self.registry.default
+
+
+def knownNames() -> Tuple[str, ...]:
+    """
+    Get the name of every value in util.locations without compiling any layouts
+    :return: Names in the order the registry lists them
+    """
+    locationLists = [_locations.locations] + list(getattr(_locations, "layouts", {}).values())
+    return tuple(dict.fromkeys(location[2] for locationList in locationLists for location in locationList))
+
+
+_detector: Optional[LayoutDetector] = None
+_buildLock = threading.Lock()
+
+
+def _build() -> LayoutDetector:
+    """
+    Build the registry of every layout in util.locations and its detector, once
+    :return: The detector, holding the registry
+    """
+    global _detector, layouts, detector
+    if _detector is None:
+        with _buildLock:
+            if _detector is None:
+                layouts = LayoutRegistry(Layout(None, _locations.locations),
+                                         [Layout(version, versionLocations) for version, versionLocations
+                                          in getattr(_locations, "layouts", {}).items()])
+                detector = _detector = LayoutDetector(layouts)
+    return _detector
+
+
+def layoutFor(version: Optional[str]) -> Layout:
+    """
+    Get the registered layout of a game version, falling back to the default layout
+    :param version: Version string. None for the default layout
+    :return: The version's layout
+    """
+    return _build().registry.get(version)
+
+
+def __getattr__(name: str):
+    # The registry and detector are built on first use, then kept as plain module globals
+    if name in ("layouts", "detector"):
+        _build()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+if __name__ == "__main__":
+    import pickle
+
+    testLayout = Layout("1.0.7.0\0", [(0, 4, "deathcounter", int), (8, 6, "position", list), (4, 3, "version", str)])
+    assert testLayout.version == "1.0.7.0", "layout version fail. Got " + str(testLayout.version) + " instead"
+    assert testLayout.fieldsByOffset[8].name == "position" and testLayout.fieldsByName["version"].offset == 4, \
+        "layout lookup fail"
+    assert (testLayout.start, testLayout.end) == (0, 14), \
+        "layout range fail. Got " + str((testLayout.start, testLayout.end)) + " instead"
+    assert testLayout.ranges == [(0, 7), (8, 14)], "layout ranges fail. Got " + str(testLayout.ranges) + " instead"
+    assert mergeRanges([(0, 4), (2, 4), (10, 2)]) == [(0, 6), (10, 12)], "merge ranges fail"
+
+    for testLocations, testError in (([(0, 4, "slot", int), (4, 4, "slot", int)], ValueError),
+                                     ([(0, 4, "slot", int), (0, 2, "other", int)], ValueError),
+                                     ([(0, 4, "layout", int)], ValueError),
+                                     ([(0, 4, "__class__", int)], ValueError),
+                                     ([(-1, 4, "slot", int)], ValueError),
+                                     ([(0, 4, "position", list)], ValueError),
+                                     ([(0, 4, "slot", float)], TypeError)):
+        try:
+            Layout("0", testLocations)
+            assert False, "layout validation fail. Accepted " + str(testLocations)
+        except testError:
+            pass
+
+    testRegistry = LayoutRegistry(Layout(None, [(0, 4, "deathcounter", int)]), [testLayout])
+    assert testRegistry.get("1.0.7.0") is testLayout and "1.0.7.0 " in testRegistry, "layout registry get fail"
+    assert testRegistry.get("9.9.9.9") is testRegistry.default, "layout registry fallback fail"
+    try:
+        testRegistry.get("9.9.9.9", False)
+        assert False, "layout registry strict fail"
+    except KeyError:
+        pass
+    try:
+        testRegistry.register(Layout("1.0.7.0", []))
+        assert False, "layout registry duplicate fail"
+    except ValueError:
+        pass
+    assert testRegistry.names == ("deathcounter", "position", "version"), \
+        "layout registry names fail. Got " + str(testRegistry.names) + " instead"
+    testDefault = layoutFor(None)
+    assert pickle.loads(pickle.dumps(testDefault)) is testDefault, "layout pickle fail"
+    testCopy = pickle.loads(pickle.dumps(testLayout))
+    assert testCopy is not testLayout and testCopy.version == testLayout.version \
+        and testCopy.fields == testLayout.fields, "layout unregistered pickle fail. Got " + str(testCopy) + " instead"
+    assert knownNames() == tuple(dict.fromkeys(name for layout in _build().registry for name in layout.names)), \
+        "layout known names fail. Got " + str(knownNames()) + " instead"
+
+    testDetector = LayoutDetector(testRegistry)
+    testBuffer = bytearray(14)
+    testBuffer[4:7] = b"1.0"
+    assert testDetector.detect(testBuffer) is testRegistry.default, "layout detect default fail"
+    assert testDetector.readLength("slot_0.sav") == 14, "layout read length fail"
+    testVersionLayout = Layout("1.0", [(0, 2, "deathcounter", int), (4, 3, "version", str)])
+    testRegistry.register(testVersionLayout)
+    testDetector.forget()
+    assert testDetector.detect(testBuffer, "slot_0.sav") is testVersionLayout, "layout detect version fail"
+    assert testDetector.readLength("slot_0.sav") == 7, \
+        "layout file cache fail. Got " + str(testDetector.readLength("slot_0.sav")) + " instead"
+
+    print("All tests passed successfully")
@@ -0,0 +1,122 @@
+"""
+Optional metrics for the read, compare, write and monitor paths.
+Nothing is measured until a sink is enabled, and until then each instrumented call only checks that sink is None.
+The sinks themselves live in util.sinks, which is only imported once one is made.
+"""
+import atexit
+import os
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from util.sinks import MemorySink
+
+# The enabled sink, or None when metrics are off. Instrumented code reads this once per call
+sink: Optional["MemorySink"] = None
+_flushRegistered = False
+
+
+def enable(newSink: "MemorySink") -> "MemorySink":
+    """
+    Start recording metrics. Any sink enabled before is flushed and replaced
+    :param newSink: Sink to record into
+    :return: The sink
+    """
+    global sink, _flushRegistered
+    if sink is not None:
+        sink.flush()
+    if not _flushRegistered:
+        atexit.register(_flushAtExit)
+        _flushRegistered = True
+    sink = newSink
+    return newSink
+
+
+def disable():
+    """
+    Stop recording metrics, flushing the sink first
+    """
+    global sink
+    if sink is not None:
+        sink.flush()
+    sink = None
+
+
+def fromSpec(spec: Optional[str]) -> Optional["MemorySink"]:
+    """
+    Enable a sink from a short description: "memory", a .prom file for Prometheus text, or any other file for JSON
+    :param spec: Description of the sink. None or empty leaves metrics off
+    :return: The enabled sink, or None
+    """
+    if not spec:
+        return None
+    from util.sinks import MemorySink, JsonSink, PrometheusSink
+    if spec == "memory":
+        return enable(MemorySink())
+    if spec.endswith(".prom"):
+        return enable(PrometheusSink(spec))
+    return enable(JsonSink(spec))
+
+
+def fromEnvironment() -> Optional["MemorySink"]:
+    """
+    Enable the sink described by the POL_METRICS environment variable, if it is set
+    :return: The enabled sink, or None
+    """
+    return fromSpec(os.getenv("POL_METRICS"))
+
+
+def __getattr__(name: str):
+    # The sink classes, imported on first use so instrumented modules don't load them just to check sink
+    if name in ("MemorySink", "JsonSink", "PrometheusSink"):
+        from util import sinks
+        return getattr(sinks, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _flushAtExit():
+    if sink is not None:
+        try:
+            sink.flush()
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    import json
+    import tempfile
+    from util.sinks import MemorySink
+
+    testSink = enable(MemorySink())
+    testSink.count("bytes_read_total", 10)
+    testSink.count("bytes_read_total", 5)
+    testSink.observe("read_seconds", 0.5)
+    testSink.observe("read_seconds", 1.5)
+    assert testSink.snapshot() == {"counters": {"bytes_read_total": 15},
+                                   "timings": {"read_seconds": {"count": 2, "sum": 2.0, "min": 0.5, "max": 1.5}}}, \
+        "metrics memory fail. Got " + str(testSink.snapshot()) + " instead"
+    disable()
+    assert sink is None, "metrics disable fail"
+    try:
+        from util.sinks import _FileSink
+        _FileSink("metrics.txt")
+        assert False, "metrics file sink fail. Made a sink without a format"
+    except TypeError:
+        pass
+
+    with tempfile.TemporaryDirectory() as testDirectory:
+        testFile = os.path.join(testDirectory, "metrics.prom")
+        testSink = fromSpec(testFile)
+        testSink.count("polls_total", 3)
+        testSink.observe("read_seconds", 0.25)
+        disable()
+        with open(testFile) as testOutput:
+            testText = testOutput.read()
+        assert "pol_polls_total 3" in testText and "pol_read_seconds_count 1" in testText, \
+            "metrics prometheus fail. Got " + testText + " instead"
+        testFile = os.path.join(testDirectory, "metrics.json")
+        fromSpec(testFile).count("polls_total")
+        disable()
+        with open(testFile) as testOutput:
+            assert json.load(testOutput)["counters"] == {"polls_total": 1}, "metrics json fail"
+
+    print("All tests passed successfully")
@@ -0,0 +1,187 @@
+"""Notifier class for change alerts that play a sound, ring the terminal bell or call a hook without blocking"""
+import sys
+import threading
+import time
+from typing import Optional, Callable, List
+
+from util import metrics
+
+
+class _SoundPlayer:
+    """
+    Plays a sound that was decoded into PCM once, so each alert only has to copy samples to the device
+    """
+
+    def __init__(self, file):
+        import miniaudio
+        self.__miniaudio = miniaudio
+        self.__sound = miniaudio.decode_file(file)
+
+    def __stream(self, done: threading.Event):
+        samples = self.__sound.samples
+        channels = self.__sound.nchannels
+        position = 0
+        frames = yield b""
+        while position < len(samples):
+            chunk = samples[position:position + frames * channels]
+            position += len(chunk)
+            frames = yield chunk
+        done.set()
+
+    def play(self):
+        done = threading.Event()
+        device = self.__miniaudio.PlaybackDevice(output_format=self.__sound.sample_format,
+                                                 nchannels=self.__sound.nchannels, sample_rate=self.__sound.sample_rate)
+        try:
+            stream = self.__stream(done)
+            next(stream)
+            device.start(stream)
+            done.wait(self.__sound.duration + 1)
+            # Let the device's buffer drain before closing it
+            time.sleep(0.2)
+        finally:
+            device.close()
+
+
+class _PlaysoundPlayer:
+    """
+    Fallback for when miniaudio isn't installed. Decodes the sound on every alert, but still off the calling thread
+    """
+
+    def __init__(self, file):
+        from playsound import playsound
+        self.__playsound = playsound
+        self.__file = file
+
+    def play(self):
+        self.__playsound(self.__file)
+
+
+class _BellPlayer:
+    """
+    Rings the terminal bell, for running without a sound or a GUI
+    """
+
+    def play(self):
+        sys.stdout.write("\a")
+        sys.stdout.flush()
+
+
+class Notifier:
+    """
+    Notifier class to raise change alerts on a background thread. The sound is decoded once when the notifier
+    starts, and alerts arriving within interval seconds of the last one are coalesced into the next.
+    """
+
+    def __init__(self, sound: Optional[str] = None, interval: float = 1.0,
+                 hook: Optional[Callable[[List[str]], None]] = None, bell: bool = True):
+        """
+        :param sound: Sound file to play. Ignore to run without sound
+        :param interval: Minimum seconds between alerts
+        :param hook: Optional function called with the messages of every alert
+        :param bell: Whether to ring the terminal bell when there is no sound to play
+        """
+        self.sound = sound
+        self.interval = interval
+        self.hook = hook
+        self.bell = bell
+        self.__messages: List[str] = []
+        self.__queued = 0.0
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.__player = None
+        self.__thread = threading.Thread(target=self.__run, name="notifier", daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def notify(self, message: str = ""):
+        """
+        Raise an alert without waiting for it
+        :param message: Message passed to the hook
+        """
+        with self.__condition:
+            if not self.__closed:
+                if not self.__messages:
+                    self.__queued = time.perf_counter()
+                self.__messages.append(message)
+                self.__condition.notify()
+
+    def close(self):
+        """
+        Stop the notifier once any waiting alert has been raised
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __load(self):
+        """
+        Get the best way of playing the sound that is available
+        :return: Player, or None to stay silent
+        """
+        if self.sound is not None:
+            try:
+                # Audio libraries are only imported here, on the notifier's own thread
+                try:
+                    return _SoundPlayer(self.sound)
+                except ImportError:
+                    return _PlaysoundPlayer(self.sound)
+            except Exception as error:
+                print(f'Could not load alert sound {self.sound}: {error}')
+        return _BellPlayer() if self.bell else None
+
+    def __run(self):
+        self.__player = self.__load()
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__messages or self.__closed)
+                messages, self.__messages = self.__messages, []
+                closed = self.__closed
+                queued = self.__queued
+            if messages:
+                sink = metrics.sink
+                if sink is not None:
+                    sink.observe("notifier_alert_latency_seconds", time.perf_counter() - queued)
+                    sink.count("notifier_alerts_total")
+                    sink.count("notifier_coalesced_total", len(messages) - 1)
+                self.__alert(messages)
+            if closed:
+                return
+            with self.__condition:
+                # Anything raised before the interval is up joins the next alert
+                self.__condition.wait_for(lambda: self.__closed, self.interval)
+
+    def __alert(self, messages: List[str]):
+        if self.hook is not None:
+            try:
+                self.hook(messages)
+            except Exception as error:
+                print("Alert hook failed: " + str(error))
+        if self.__player is None:
+            return
+        try:
+            self.__player.play()
+        except Exception as error:
+            print("Could not play alert, ringing the bell instead: " + str(error))
+            self.__player = _BellPlayer() if self.bell else None
+
+
+if __name__ == "__main__":
+    testAlerts = []
+    with Notifier(interval=0.2, hook=testAlerts.append, bell=False) as testNotifier:
+        testNotifier.notify("0")
+        time.sleep(0.05)
+        for i in range(1, 5):
+            testNotifier.notify(str(i))
+        time.sleep(0.4)
+        testNotifier.notify("5")
+    assert testAlerts == [["0"], ["1", "2", "3", "4"], ["5"]], \
+        "notify coalesce fail. Got " + str(testAlerts) + " instead"
+
+    print("All tests passed successfully")
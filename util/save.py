@@ -1,8 +1,8 @@
 """Python class for storing save information as an object"""
 from typing import List, Union, Optional
 
-from util.hexextendor import hexExtendor
-from util.locations import locations
+from util.codec import convertFromBytes
+from util.layouts import Layout, knownNames, layoutFor
 
 
 def convertFromHex(val: str, valtype: type) -> Union[int, str, list, TypeError]:
@@ -12,21 +12,8 @@ def convertFromHex(val: str, valtype: type) -> Union[int, str, list, TypeError]:
     :param valtype: What to convert to
     :return: Int or Str conversion of Reverse hex
     """
-    if valtype == int:
-        hexval = ""
-        for i in range(len(val) - 2, -1, -2):
-            hexval += val[i] + val[i + 1]
-        return int(hexval, 16)
-    elif valtype == str:
-        newval = ""
-        for i in range(0, len(val) - 1, 2):
-            newval += chr(int(val[i] + val[i + 1], 16))
-        return newval
-    elif valtype == list:
-        hexlist = [val[:4], val[4:8], val[8:12]]
-        newval = [hexlist[i][2:4] + hexlist[i][:2] for i in range(3)]
-        newval = [int(val, 16) for val in newval]
-        return newval
+    if valtype in (int, str, list):
+        return convertFromBytes(bytes.fromhex(val), valtype)
     else:
         return TypeError("Invalid conversion target type: " + str(valtype))
 
@@ -38,26 +25,14 @@ def convertToHex(val: Union[int, str, list]) -> Union[str, TypeError]:
     :return: Reversed Hex
     """
     if type(val) == int:
-        hexval = hexExtendor(val)
-        newhexval = ""
-        for i in range(len(hexval) - 2, -1, -2):
-            newhexval += hexval[i] + hexval[i + 1]
-        return newhexval
+        return val.to_bytes(max(8, (val.bit_length() + 7) // 8), "little").hex()
     elif type(val) == str:
         try:
             return convertToHex(int(val))
         except ValueError:
-            hexval = ""
-            for char in val:
-                hexval += hexExtendor(ord(char), 2)
-            newhexval = ""
-            for i in range(0, len(hexval) - 1, 2):
-                newhexval += hexval[i] + hexval[i + 1]
-            return newhexval
+            return val.encode("latin-1").hex()
     elif type(val) == list:
-        hexlist = [hexExtendor(listval, 4) for listval in val]
-        vallist = [hexlist[i][2:4] + hexlist[i][:2] for i in range(3)]
-        return "".join(vallist)
+        return b"".join(listval.to_bytes(2, "little") for listval in val[:3]).hex()
 
     else:
         return TypeError("Invalid conversion source type: " + str(type(val)))
@@ -67,35 +42,46 @@ class Save:
     """
     Class for the save data currently known in the game
     """
+    # Fixed attribute storage instead of a per-instance __dict__, including the known fields of every layout
+    __slots__ = tuple(dict.fromkeys(("timestamp", "version", "elapsed", "deathcounter", "slot", "chapterId",
+                                     "sceneId", "position") + knownNames() + ("layout",)))
 
-    def __init__(self):
+    """
+    1. Village Intro
+    3. A New Friend
+    4. Getting to know each other
+    5. The Cave
+    6. The Highlands
+    7. The Swamp
+    9. The Shipwreck
+    10. In Control
+    12. Archipelago 1
+    14. The Desert
+    15. The Desert Hut
+    16. The Robot Base
+    17. Home
+    """
+    __chapters = (1, 3, 4, 5, 6, 7, 9, 10, 12, 14, 15, 16, 17)
+    __names = __slots__[:-1]
+
+    def __init__(self, layout: Optional[Layout] = None):
+        """
+        :param layout: Layout of the game version the save is from, used to look values up by offset. Ignore to use
+        the default layout
+        """
+        self.layout = layout if layout else layoutFor(None)
         self.timestamp: Optional[int] = None
         self.version: Optional[str] = None
         self.elapsed: Optional[int] = None
         self.deathcounter: Optional[int] = None
         self.slot: Optional[int] = None
-        """
-        1. Village Intro
-        3. A New Friend
-        4. Getting to know each other
-        5. The Cave
-        6. The Highlands
-        7. The Swamp
-        9. The Shipwreck
-        10. In Control
-        12. Archipelago 1
-        14. The Desert
-        15. The Desert Hut
-        16. The Robot Base
-        17. Home
-        """
-        self.__chapters = (1, 3, 4, 5, 6, 7, 9, 10, 12, 14, 15, 16, 17)
         self.chapterId: Optional[int] = None
         self.sceneId: Optional[int] = None
         self.position: List[Optional[int]] = [None, None, None]
         # TODO - Shrines
-
-        self.__locations = locations
+        for name in self.__names:
+            if not hasattr(self, name):
+                self.__setattr__(name, None)
 
     def get(self, attr: Union[str, int]) -> Union[str, AttributeError, KeyError]:
         """
@@ -104,10 +90,10 @@ class Save:
         :return: Value | Error
         """
         if type(attr) == int:
-            for location in self.__locations:
-                if location[0] == attr:
-                    return convertToHex(self.__getattribute__(location[2]))
-            raise KeyError("No such save location currently known: " + str(attr))
+            field = self.layout.fieldsByOffset.get(attr)
+            if field is None:
+                raise KeyError("No such save location currently known: " + str(attr))
+            return convertToHex(self.__getattribute__(field.name))
 
         else:
             if attr[:2] == "__":
@@ -126,21 +112,17 @@ class Save:
         :return: None | Error
         """
         if type(key) == int:
-            for location in self.__locations:
-                if location[0] == key:
-                    val = convertFromHex(val, location[3])
-                    self.__setattr__(location[2], val)
-                    return
-            raise KeyError("No such save location currently known: " + str(key))
+            field = self.layout.fieldsByOffset.get(key)
+            if field is None:
+                raise KeyError("No such save location currently known: " + str(key))
+            self.__setattr__(field.name, convertFromHex(val, field.type))
         else:
             if key[:2] == "__":
                 raise AttributeError("Trying to access protected value: " + str(key))
-            for location in self.__locations:
-                if location[2] == key:
-                    val = convertFromHex(val, location[3])
-                    self.__setattr__(key, val)
-                    return
-            raise KeyError("No such save value currently known: " + str(key))
+            field = self.layout.fieldsByName.get(key)
+            if field is None:
+                raise KeyError("No such save value currently known: " + str(key))
+            self.__setattr__(key, convertFromHex(val, field.type))
 
 
 if __name__ == "__main__":
@@ -154,6 +136,13 @@ if __name__ == "__main__":
     assert convertFromHex("312e302e372e30", str) == "1.0.7.0", \
         "str convert from hex fail. Got " + str(convertFromHex("312e302e372e30", str)) + " instead"
 
+    assert convertFromBytes(b"\x0f\x00\x00\x00", int) == 15, \
+        "int convert from bytes fail. Got " + str(convertFromBytes(b"\x0f\x00\x00\x00", int)) + " instead"
+    assert convertFromBytes(b"1.0.7.0", str) == "1.0.7.0", \
+        "str convert from bytes fail. Got " + str(convertFromBytes(b"1.0.7.0", str)) + " instead"
+    assert convertFromBytes(bytes.fromhex("0c000d000e00"), list) == [12, 13, 14], \
+        "list convert from bytes fail. Got " + str(convertFromBytes(bytes.fromhex("0c000d000e00"), list)) + " instead"
+
     assert convertToHex([12, 13, 14]) == "0c000d000e00", \
         "list convert to hex fail. Got " + str(convertToHex([12, 13, 14])) + " instead"
     assert convertFromHex("0c000d000e00", list) == [12, 13, 14], \
@@ -163,8 +152,7 @@ if __name__ == "__main__":
     saveFile.set("position", "0c000d000e00")
     assert saveFile.position == [12, 13, 14], \
         "Save file set fail. Got " + str(saveFile.position) + " instead"
-    # Illegal access of private attribute to allow secure testing of hex value access
-    assert saveFile.get(saveFile._Save__locations[-1][0]) == "0c000d000e00", \
+    assert saveFile.get(saveFile.layout.fieldsByName["position"].offset) == "0c000d000e00", \
         "Save file get fail. Got " + str(saveFile.get("position")) + " instead"
 
     print("All tests passed successfully")
@@ -0,0 +1,134 @@
+"""Metric sinks keeping counters and timings, only imported once util.metrics is used to record something"""
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Any
+
+
+class MemorySink:
+    """
+    MemorySink class keeping counters and timing summaries in memory
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters: Dict[str, float] = {}
+        self.__timings: Dict[str, Dict[str, float]] = {}
+
+    def count(self, name: str, value: float = 1):
+        """
+        Add to a counter
+        :param name: Counter name
+        :param value: Amount to add
+        """
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+        self._updated()
+
+    def observe(self, name: str, seconds: float):
+        """
+        Record a timing
+        :param name: Timing name
+        :param seconds: Time taken
+        """
+        with self.__lock:
+            timing = self.__timings.get(name)
+            if timing is None:
+                self.__timings[name] = {"count": 1, "sum": seconds, "min": seconds, "max": seconds}
+            else:
+                timing["count"] += 1
+                timing["sum"] += seconds
+                timing["min"] = min(timing["min"], seconds)
+                timing["max"] = max(timing["max"], seconds)
+        self._updated()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get a copy of everything recorded so far
+        :return: Dict of {"counters": {name: value}, "timings": {name: {count, sum, min, max}}}
+        """
+        with self.__lock:
+            return {"counters": dict(self.__counters),
+                    "timings": {name: dict(timing) for name, timing in self.__timings.items()}}
+
+    def reset(self):
+        """
+        Forget everything recorded so far
+        """
+        with self.__lock:
+            self.__counters.clear()
+            self.__timings.clear()
+
+    def flush(self):
+        """
+        Write anything recorded out. Memory sinks have nowhere to write to
+        """
+
+    def _updated(self):
+        pass
+
+
+class _FileSink(MemorySink, ABC):
+    """
+    Base for sinks that rewrite a file with everything recorded, at most once every interval seconds and on exit
+    """
+
+    def __init__(self, file, interval: float = 5):
+        super().__init__()
+        self.file = file
+        self.interval = interval
+        self.__written = time.monotonic()
+
+    def flush(self):
+        text = self._format(self.snapshot())
+        directory, name = os.path.split(os.path.abspath(self.file))
+        # Replace the file in one go so anything scraping it never sees half of it
+        temp = os.path.join(directory, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(temp, "w") as output:
+            output.write(text)
+        os.replace(temp, self.file)
+        self.__written = time.monotonic()
+
+    def _updated(self):
+        if time.monotonic() - self.__written >= self.interval:
+            self.__written = time.monotonic()
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    @abstractmethod
+    def _format(self, recorded: Dict[str, Any]) -> str:
+        """
+        Format everything recorded as the file's contents
+        :param recorded: Snapshot of everything recorded
+        :return: Text to write
+        """
+
+
+class JsonSink(_FileSink):
+    """
+    JsonSink class writing everything recorded to a JSON file
+    """
+
+    def _format(self, recorded: Dict[str, Any]) -> str:
+        import json
+        return json.dumps(recorded, indent=2) + "\n"
+
+
+class PrometheusSink(_FileSink):
+    """
+    PrometheusSink class writing everything recorded to a Prometheus text file, e.g. for node_exporter's textfile
+    collector. Timings are written as summaries in seconds with a separate _max gauge
+    """
+
+    def _format(self, recorded: Dict[str, Any]) -> str:
+        lines = []
+        for name, value in sorted(recorded["counters"].items()):
+            lines += [f'# TYPE pol_{name} counter', f'pol_{name} {value}']
+        for name, timing in sorted(recorded["timings"].items()):
+            lines += [f'# TYPE pol_{name} summary', f'pol_{name}_sum {timing["sum"]}',
+                      f'pol_{name}_count {timing["count"]}', f'# TYPE pol_{name}_max gauge',
+                      f'pol_{name}_max {timing["max"]}']
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,222 @@
+"""Content addressed snapshot store for logging save files without keeping duplicate copies"""
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Optional, List, Tuple, NamedTuple, Dict
+
+from util.consistent import readConsistentStat, ShortFileError
+from util.layouts import detector
+
+
+class SnapshotEntry(NamedTuple):
+    """
+    A single logged save. Either a full blob (base == hash, no delta) or the changed field ranges of a base blob
+    """
+    time: float
+    session: str
+    hash: str
+    base: str
+    delta: Optional[Tuple[Tuple[int, str], ...]]
+
+
+class SnapshotStore:
+    """
+    Snapshot store keeping every distinct save once under its sha256 hash.
+    Saves that only differ from the current base blob inside the known locations are stored as just those byte
+    ranges, and an index.jsonl file records the time, session and contents of every snapshot.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.__blobs = os.path.join(root, "blobs")
+        self.__index = os.path.join(root, "index.jsonl")
+        self.__lock = threading.Lock()
+        self.__base: Optional[Tuple[str, bytes]] = None
+        self.__entries: Optional[List[SnapshotEntry]] = None
+        self.__hashes: Dict[str, SnapshotEntry] = {}
+        os.makedirs(self.__blobs, exist_ok=True)
+
+    def __blobPath(self, digest: str) -> str:
+        return os.path.join(self.__blobs, digest + ".sav")
+
+    def __readBlob(self, digest: str) -> bytes:
+        if self.__base is not None and self.__base[0] == digest:
+            return self.__base[1]
+        with open(self.__blobPath(digest), "rb") as blob:
+            return blob.read()
+
+    def __delta(self, base: bytes, data: bytes) -> Optional[Tuple[Tuple[int, str], ...]]:
+        """
+        Get the changed known locations between the base and the data
+        :param base: Base blob
+        :param data: New save data
+        :return: Tuple of (offset, hex bytes), or None if anything outside the known locations changed, or the two
+            saves have different layouts
+        """
+        if len(base) != len(data):
+            return None
+        layout = detector.detect(data)
+        if detector.detect(base) is not layout:
+            return None
+        base = memoryview(base)
+        data = memoryview(data)
+        delta = []
+        last = 0
+        for start, end in layout.ranges + [(len(data), len(data))]:
+            if base[last:start] != data[last:start]:
+                return None
+            if base[start:end] != data[start:end]:
+                delta.append((start, data[start:end].hex()))
+            last = end
+        return tuple(delta)
+
+    def add(self, data: bytes, session: str = "", when: Optional[float] = None) -> SnapshotEntry:
+        """
+        Store a snapshot of some save data
+        :param data: Full raw save data
+        :param session: Name to group the snapshot under
+        :param when: Unix time of the snapshot. Ignore to use the current time
+        :return: Index entry for the snapshot
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        when = time.time() if when is None else when
+        with self.__lock:
+            known = self.__known(digest)
+            if known is not None:
+                entry = SnapshotEntry(when, session, digest, known.base, known.delta)
+            else:
+                if self.__base is None:
+                    last = next((entry for entry in reversed(self.entries()) if entry.delta is None), None)
+                    if last is not None:
+                        self.__base = (last.base, self.__readBlob(last.base))
+                delta = self.__delta(self.__base[1], data) if self.__base is not None else None
+                if delta is not None:
+                    entry = SnapshotEntry(when, session, digest, self.__base[0], delta)
+                else:
+                    temp = self.__blobPath(digest) + ".tmp"
+                    with open(temp, "wb") as blob:
+                        blob.write(data)
+                    os.replace(temp, self.__blobPath(digest))
+                    entry = SnapshotEntry(when, session, digest, digest, None)
+            if entry.delta is None:
+                self.__base = (digest, bytes(data))
+            with open(self.__index, "a") as index:
+                index.write(json.dumps(entry._asdict()) + "\n")
+            self.__entries.append(entry)
+            self.__hashes[digest] = entry
+        return entry
+
+    def __known(self, digest: str) -> Optional[SnapshotEntry]:
+        """
+        Find an earlier snapshot with the same contents
+        :param digest: sha256 of the save data
+        :return: Earlier entry, if there is one
+        """
+        self.entries()
+        if digest not in self.__hashes and os.path.exists(self.__blobPath(digest)):
+            return SnapshotEntry(0, "", digest, digest, None)
+        return self.__hashes.get(digest)
+
+    def addFile(self, file, session: str = "", when: Optional[float] = None) -> SnapshotEntry:
+        """
+        Store a snapshot of a save file. The file is read consistently, so a save the game is still writing is never
+        stored. Raises TornReadError if it never stops changing, or ShortFileError if it is too short to hold every
+        known location of its layout
+        :param file: File to snapshot
+        :param session: Name to group the snapshot under
+        :param when: Unix time of the snapshot. Ignore to use the current time
+        :return: Index entry for the snapshot
+        """
+        data, stat = readConsistentStat(file)
+        end = detector.detect(data, file).end
+        if len(data) < end:
+            raise ShortFileError(file, len(data), end, stat)
+        return self.add(data, session, when)
+
+    def entries(self, session: Optional[str] = None) -> List[SnapshotEntry]:
+        """
+        Get the index of every stored snapshot in the order they were added
+        :param session: Optional session to limit the entries to
+        :return: List of entries
+        """
+        if self.__entries is None:
+            self.__entries = []
+            if os.path.exists(self.__index):
+                with open(self.__index) as index:
+                    for line in index:
+                        if line.strip():
+                            entry = json.loads(line)
+                            delta = tuple(tuple(change) for change in entry["delta"]) \
+                                if entry["delta"] is not None else None
+                            entry = SnapshotEntry(entry["time"], entry["session"], entry["hash"], entry["base"],
+                                                  delta)
+                            self.__entries.append(entry)
+                            self.__hashes[entry.hash] = entry
+        return [entry for entry in self.__entries if session is None or entry.session == session]
+
+    def sessions(self) -> Dict[str, int]:
+        """
+        Get every session in the store
+        :return: Dict of {session: snapshot count}
+        """
+        counts = {}
+        for entry in self.entries():
+            counts[entry.session] = counts.get(entry.session, 0) + 1
+        return counts
+
+    def load(self, entry: SnapshotEntry) -> bytes:
+        """
+        Rebuild the full save data of a snapshot
+        :param entry: Index entry to load
+        :return: Full raw save data
+        """
+        data = bytearray(self.__readBlob(entry.base))
+        for offset, change in entry.delta or ():
+            change = bytes.fromhex(change)
+            data[offset:offset + len(change)] = change
+        if hashlib.sha256(data).hexdigest() != entry.hash:
+            raise ValueError("Snapshot does not match its hash: " + str(entry.hash))
+        return bytes(data)
+
+    def export(self, entry: SnapshotEntry, file):
+        """
+        Write a snapshot back out as a normal save file
+        :param entry: Index entry to export
+        :param file: File to write to
+        """
+        with open(file, "wb") as savefile:
+            savefile.write(self.load(entry))
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as testDirectory:
+        testStore = SnapshotStore(testDirectory)
+        testData = bytearray(range(256)) * 4
+        first = testStore.add(bytes(testData), "test", 1)
+        assert first.delta is None, "snapshot base fail. Got " + str(first) + " instead"
+        assert testStore.add(bytes(testData), "test", 2).base == first.hash, "snapshot dedupe fail"
+        field = detector.detect(testData).fields[0]
+        testData[field.offset] ^= 0xff
+        second = testStore.add(bytes(testData), "test", 3)
+        assert second.base == first.hash and second.delta is not None, \
+            "snapshot delta fail. Got " + str(second) + " instead"
+        assert SnapshotStore(testDirectory).load(second) == bytes(testData), "snapshot reload fail"
+        assert testStore.add(bytes(testData), "test", 3.5).delta == second.delta, "snapshot delta dedupe fail"
+        testData[-1] ^= 0xff
+        assert testStore.add(bytes(testData), "other", 4).delta is None, "snapshot unknown change fail"
+        assert len(os.listdir(os.path.join(testDirectory, "blobs"))) == 2, "snapshot blob count fail"
+        assert SnapshotStore(testDirectory).sessions() == {"test": 4, "other": 1}, "snapshot session fail"
+        testFile = os.path.join(testDirectory, "slot_0.sav")
+        with open(testFile, "wb") as testSave:
+            testSave.write(bytes(testData[:detector.detect(testData).end - 1]))
+        try:
+            testStore.addFile(testFile)
+            assert False, "snapshot short file fail"
+        except ShortFileError:
+            pass
+
+    print("All tests passed successfully")
@@ -0,0 +1,249 @@
+"""SQLite index of decoded save values over a folder of logged snapshots"""
+import datetime
+import glob
+import os
+import sqlite3
+from typing import Optional, List, Dict, Any, Tuple
+
+from util.layouts import Field, detector
+from util.snapshots import SnapshotStore
+
+_SQL_TYPES = {int: "INTEGER", str: "TEXT"}
+
+
+def _fields() -> List[Field]:
+    """
+    Get the value of every registered layout, taking each name's type from the first layout with it
+    :return: List of fields in the order the registry lists their names
+    """
+    fields = {}
+    for layout in detector.registry:
+        for field in layout.fields:
+            fields.setdefault(field.name, field)
+    return list(fields.values())
+
+
+def _columns(fields: List[Field]) -> List[Tuple[str, str]]:
+    """
+    Get the snapshot table's value columns, with list values split into one column per item
+    :param fields: Values to make columns for
+    :return: List of (column, SQL type)
+    """
+    columns = []
+    for field in fields:
+        if field.type == list:
+            columns.extend((f'{field.name}_{i}', "INTEGER") for i in range(3))
+        else:
+            columns.append((field.name, _SQL_TYPES[field.type]))
+    return columns
+
+
+class Timeline:
+    """
+    Timeline class holding the decoded values of every snapshot in a SQLite database, so the history of a run can
+    be queried without reading the snapshots again. Updating only decodes snapshots that weren't indexed before.
+    Each snapshot is decoded with the layout of its game version, leaving the values its layout doesn't have NULL.
+    """
+
+    def __init__(self, database=":memory:"):
+        self.__fields = _fields()
+        self.__columns = _columns(self.__fields)
+        self.__names = {column for column, _ in self.__columns}
+        self.__db = sqlite3.connect(database)
+        self.__db.row_factory = sqlite3.Row
+        values = "".join(f', "{column}" {sqlType}' for column, sqlType in self.__columns)
+        with self.__db:
+            self.__db.execute(f'CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, source TEXT UNIQUE, '
+                              f'session TEXT, time REAL, hash TEXT{values})')
+            self.__db.execute("CREATE INDEX IF NOT EXISTS snapshotTimes ON snapshots (session, time)")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER)")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS stores (root TEXT PRIMARY KEY, entries INTEGER)")
+            existing = {row["name"] for row in self.__db.execute("PRAGMA table_info(snapshots)")}
+            for column, sqlType in self.__columns:
+                if column not in existing:
+                    self.__db.execute(f'ALTER TABLE snapshots ADD COLUMN "{column}" {sqlType}')
+
+    def close(self):
+        """
+        Close the database
+        """
+        self.__db.close()
+
+    def add(self, source: str, data: bytes, when: float, session: str = "", digest: Optional[str] = None) -> bool:
+        """
+        Decode and index a single snapshot, replacing any earlier one from the same source
+        :param source: Unique name of where the snapshot came from
+        :param data: Raw save data
+        :param when: Unix time of the snapshot
+        :param session: Session the snapshot belongs to
+        :param digest: Optional hash of the snapshot
+        :return: Whether the snapshot could be decoded
+        """
+        layout = detector.detect(data)
+        if len(data) < layout.end:
+            return False
+        decoded = layout.codec.decode(data)
+        values = []
+        for field in self.__fields:
+            own = layout.fieldsByName.get(field.name)
+            value = decoded[field.name] if own is not None and own.type == field.type else None
+            if field.type == list:
+                values.extend(value[:3] if value is not None else (None, None, None))
+            else:
+                values.append(value)
+        columns = "".join(f', "{column}"' for column, _ in self.__columns)
+        self.__db.execute(f'INSERT OR REPLACE INTO snapshots (source, session, time, hash{columns}) '
+                          f'VALUES (?, ?, ?, ?{", ?" * len(values)})', [source, session, when, digest] + values)
+        return True
+
+    def update(self, folder) -> int:
+        """
+        Index any new or changed snapshots in a snapshot store or a folder of .sav files
+        :param folder: Snapshot store or folder to index
+        :return: Number of snapshots added
+        """
+        with self.__db:
+            if os.path.exists(os.path.join(folder, "index.jsonl")):
+                return self.__updateStore(folder)
+            return self.__updateFolder(folder)
+
+    def __updateStore(self, root) -> int:
+        store = SnapshotStore(root)
+        root = os.path.abspath(root)
+        row = self.__db.execute("SELECT entries FROM stores WHERE root = ?", (root,)).fetchone()
+        done = row["entries"] if row else 0
+        entries = store.entries()
+        added = 0
+        for i in range(done, len(entries)):
+            entry = entries[i]
+            added += self.add(f'{root}#{i}', store.load(entry), entry.time, entry.session, entry.hash)
+        self.__db.execute("INSERT OR REPLACE INTO stores (root, entries) VALUES (?, ?)", (root, len(entries)))
+        return added
+
+    def __updateFolder(self, folder) -> int:
+        added = 0
+        for path in sorted(glob.glob(os.path.join(folder, "**", "*.sav"), recursive=True)):
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            row = self.__db.execute("SELECT mtime, size FROM files WHERE path = ?", (path,)).fetchone()
+            if row and row["mtime"] == stat.st_mtime_ns and row["size"] == stat.st_size:
+                continue
+            # Logged copies are named after when they were taken
+            try:
+                when = datetime.datetime.strptime(os.path.splitext(os.path.basename(path))[0],
+                                                  "%Y%m%d - %H%M%S").timestamp()
+            except ValueError:
+                when = stat.st_mtime
+            with open(path, "rb") as savefile:
+                data = savefile.read(detector.readLength(path))
+                layout = detector.detect(data, path)
+                if len(data) < layout.end:
+                    data += savefile.read(layout.end - len(data))
+            added += self.add(path, data, when, os.path.basename(os.path.dirname(path)))
+            self.__db.execute("INSERT OR REPLACE INTO files (path, mtime, size) VALUES (?, ?, ?)",
+                              (path, stat.st_mtime_ns, stat.st_size))
+        return added
+
+    def __where(self, conditions: Dict[str, Any], session: Optional[str]) -> Tuple[str, List[Any]]:
+        unknown = [name for name in conditions if name not in self.__names]
+        if unknown:
+            raise KeyError("No such save value currently known: " + ", ".join(unknown))
+        clauses = [f'"{name}" = ?' for name in conditions]
+        params = list(conditions.values())
+        if session is not None:
+            clauses.append("session = ?")
+            params.append(session)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def first(self, session: Optional[str] = None, **conditions) -> Optional[Dict[str, Any]]:
+        """
+        Find the earliest snapshot with the given values, e.g. first(chapterId=14)
+        :param session: Optional session to search in
+        :param conditions: Values the snapshot must have
+        :return: Snapshot row, or None if there isn't one
+        """
+        where, params = self.__where(conditions, session)
+        row = self.__db.execute(f'SELECT * FROM snapshots{where} ORDER BY time, id LIMIT 1', params).fetchone()
+        return dict(row) if row else None
+
+    def snapshots(self, session: Optional[str] = None, **conditions) -> List[Dict[str, Any]]:
+        """
+        Get every snapshot with the given values in time order
+        :param session: Optional session to search in
+        :param conditions: Values the snapshots must have
+        :return: List of snapshot rows
+        """
+        where, params = self.__where(conditions, session)
+        return [dict(row) for row in self.__db.execute(f'SELECT * FROM snapshots{where} ORDER BY time, id', params)]
+
+    def deathsPerChapter(self, session: Optional[str] = None) -> Dict[int, int]:
+        """
+        Count the deaths in each chapter from the rise in the death counter between consecutive snapshots
+        :param session: Optional session to count in
+        :return: Dict of {chapterId: deaths}
+        """
+        where, params = self.__where({}, session)
+        rows = self.__db.execute(f'SELECT chapterId, SUM(MAX(0, deathcounter - previous)) AS deaths FROM ('
+                                 f'SELECT chapterId, deathcounter, LAG(deathcounter) OVER '
+                                 f'(PARTITION BY session ORDER BY time, id) AS previous FROM snapshots{where}) '
+                                 f'WHERE previous IS NOT NULL GROUP BY chapterId ORDER BY chapterId', params)
+        return {row["chapterId"]: row["deaths"] for row in rows}
+
+    def query(self, sql: str, params: Tuple[Any, ...] = ()) -> List[Dict[str, Any]]:
+        """
+        Run any read query against the snapshots table
+        :param sql: SQL query
+        :param params: Query parameters
+        :return: List of result rows
+        """
+        return [dict(row) for row in self.__db.execute(sql, params)]
+
+
+if __name__ == "__main__":
+    import tempfile
+    from util.layouts import Layout, layouts
+
+    testDefault = layouts.default
+    with tempfile.TemporaryDirectory() as testDirectory:
+        testStore = SnapshotStore(testDirectory)
+        testData = bytearray(testDefault.end)
+        deathField = testDefault.fieldsByName["deathcounter"]
+        chapterField = testDefault.fieldsByName["chapterId"]
+        for testTime, (testChapter, testDeaths) in enumerate([(5, 1), (5, 3), (14, 3), (14, 7)]):
+            testData[chapterField.offset:chapterField.offset + chapterField.length] = \
+                testChapter.to_bytes(chapterField.length, "little")
+            testData[deathField.offset:deathField.offset + deathField.length] = \
+                testDeaths.to_bytes(deathField.length, "little")
+            testStore.add(bytes(testData), "test", testTime)
+        testTimeline = Timeline()
+        assert testTimeline.update(testDirectory) == 4, "timeline update fail"
+        assert testTimeline.update(testDirectory) == 0, "timeline incremental update fail"
+        assert testTimeline.first(chapterId=14)["time"] == 2, \
+            "timeline first fail. Got " + str(testTimeline.first(chapterId=14)) + " instead"
+        assert testTimeline.deathsPerChapter() == {5: 2, 14: 4}, \
+            "timeline deaths fail. Got " + str(testTimeline.deathsPerChapter()) + " instead"
+        testTimeline.close()
+
+    # A newer game version keeping its death counter and chapter after the default layout's locations
+    testVersionField = testDefault.fieldsByName["version"]
+    testVersion = "9" * testVersionField.length
+    testLayout = Layout(testVersion, [(testVersionField.offset, testVersionField.length, "version", str),
+                                      (testDefault.end, 4, "deathcounter", int),
+                                      (testDefault.end + 4, 4, "chapterId", int)])
+    layouts.register(testLayout)
+    detector.forget()
+    with tempfile.TemporaryDirectory() as testDirectory:
+        testData = bytearray(testLayout.end)
+        testData[testVersionField.offset:testVersionField.offset + testVersionField.length] = testVersion.encode()
+        testData[testDefault.end] = 5
+        testData[testDefault.end + 4] = 14
+        with open(os.path.join(testDirectory, "20240101 - 120000.sav"), "wb") as testSave:
+            testSave.write(testData)
+        testTimeline = Timeline()
+        assert testTimeline.update(testDirectory) == 1, "timeline version update fail"
+        testRow = testTimeline.snapshots()[0]
+        assert (testRow["deathcounter"], testRow["chapterId"], testRow.get("sceneId")) == (5, 14, None), \
+            "timeline version decode fail. Got " + str(testRow) + " instead"
+        testTimeline.close()
+
+    print("All tests passed successfully")
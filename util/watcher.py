@@ -0,0 +1,339 @@
+"""Save watcher for noticing when a save file has been rewritten"""
+import os
+import select
+import struct
+import sys
+import time
+import zlib
+from typing import Optional, Tuple, List, Iterable
+
+from util.consistent import readConsistentStat, TornReadError, ShortFileError
+from util.layouts import Layout, mergeRanges, detector
+
+# inotify event flags for a file that has finished being written or has been replaced
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII")
+
+
+class _Inotify:
+    """
+    Linux inotify watch on the file's folder, so replaced files are also noticed
+    """
+
+    def __init__(self, file):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__name = os.fsencode(os.path.basename(file))
+        self.__fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        directory = os.fsencode(os.path.dirname(os.path.abspath(file)))
+        if libc.inotify_add_watch(self.__fd, directory, _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+            os.close(self.__fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait for the file to be written or replaced
+        :param timeout: Seconds to wait for
+        :return: Whether the file changed
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            ready, _, _ = select.select([self.__fd], [], [], max(0.0, deadline - time.monotonic()))
+            if not ready:
+                return False
+            if self.__drain():
+                return True
+
+    def __drain(self) -> bool:
+        """
+        Read every pending event
+        :return: Whether any of them were for the watched file
+        """
+        changed = False
+        try:
+            data = os.read(self.__fd, 4096)
+        except BlockingIOError:
+            return False
+        i = 0
+        while i < len(data):
+            _, _, _, length = _EVENT.unpack_from(data, i)
+            name = data[i + _EVENT.size:i + _EVENT.size + length].rstrip(b"\0")
+            changed = changed or name == self.__name
+            i += _EVENT.size + length
+        return changed
+
+    def close(self):
+        """
+        Stop watching the file
+        """
+        os.close(self.__fd)
+
+
+class SaveWatcher:
+    """
+    Polling watcher that only reports a save once the bytes at its known locations have changed.
+    A check first compares the file's (mtime_ns, size, inode), and only reads the file if those changed. The read is
+    then hashed over the known locations of the file's layout alone, so rewrites that leave every known value the same
+    never get decoded.
+    It polls every minInterval while the file keeps changing and backs off towards maxInterval while it is idle.
+    On Linux, wait also wakes up as soon as inotify reports the file written or replaced, so changes are picked up
+    straight away however far it has backed off. Elsewhere, or if inotify can't be used, it only polls.
+    Reads are consistent reads, so a save caught halfway through being written is never reported. A file too short to
+    be a save is marked invalid and left alone until its stats change.
+    """
+
+    def __init__(self, file, minInterval: float = 0.05, maxInterval: float = 1.0, backoff: float = 1.5,
+                 ranges: Optional[Iterable[Tuple[int, int]]] = None, retries: int = 3, full: bool = False):
+        """
+        :param file: Save file to watch
+        :param minInterval: Seconds between polls while the file is changing
+        :param maxInterval: Longest seconds between polls while the file is idle
+        :param backoff: How much longer each idle poll waits than the last
+        :param ranges: (offset, length) byte ranges to hash. Ignore to use the known locations of the layout picked
+        from the file's version on each read
+        :param retries: Retries of a read that was torn by a write, before leaving it to the next poll
+        :param full: Whether to read the whole file rather than just up to the end of its known locations. Only the
+        known locations are hashed either way
+        """
+        self.file = file
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.retries = retries
+        self.full = full
+        self.interval = minInterval
+        self.due = time.monotonic()
+        # Whether the last read found the file too short to be a save
+        self.invalid = False
+        if ranges is None:
+            self.__detector = detector
+            self.__ranges = []
+            self.__end = 0
+        else:
+            self.__detector = None
+            self.__ranges = mergeRanges(ranges)
+            self.__end = self.__ranges[-1][1] if self.__ranges else 0
+        self.__stat: Optional[Tuple[int, int, int]] = None
+        self.__hash: Optional[int] = None
+        # Only set up by the first wait, as polling callers never need it. False once it turned out unusable
+        self.__inotify: Optional[_Inotify] = None if sys.platform.startswith("linux") else False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def __statKey(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def __idle(self):
+        self.interval = min(self.maxInterval, self.interval * self.backoff)
+        self.due = time.monotonic() + self.interval
+
+    def __active(self):
+        self.interval = self.minInterval
+        self.due = time.monotonic() + self.interval
+
+    def changed(self) -> bool:
+        """
+        Check the file's stats without reading it. Backs off if they haven't changed
+        :return: Whether the file may have changed since it was last read
+        """
+        if self.__statKey() != self.__stat:
+            return True
+        self.__idle()
+        return False
+
+    def read(self) -> Optional[bytes]:
+        """
+        Read the file and hash its known locations
+        :return: Raw save data covering every known location, or the whole file if full, if any of them changed since
+        the last read, else None
+        """
+        try:
+            data, stat, ranges = self.__read()
+        except ShortFileError as error:
+            # Not a save, or not one yet, so only read it again once it changes
+            self.__stat = error.stat.st_mtime_ns, error.stat.st_size, error.stat.st_ino
+            self.invalid = True
+            self.__idle()
+            return None
+        except (FileNotFoundError, TornReadError):
+            # Missing or still being written, so check it again soon
+            self.__stat = None
+            self.invalid = False
+            self.__active()
+            return None
+        self.invalid = False
+        self.__stat = stat.st_mtime_ns, stat.st_size, stat.st_ino
+        view = memoryview(data)
+        digest = 0
+        for start, end in ranges:
+            digest = zlib.crc32(view[start:end], digest)
+        if digest == self.__hash:
+            self.__idle()
+            return None
+        self.__hash = digest
+        self.__active()
+        return data
+
+    def __read(self) -> Tuple[bytes, os.stat_result, List[Tuple[int, int]]]:
+        """
+        Read the file consistently, up to the end of its layout's known locations or all of it if full
+        :return: (raw save data, stats of the file, merged (start, end) ranges to hash)
+        """
+        if self.__detector is None:
+            data, stat = readConsistentStat(self.file, None if self.full else self.__end, self.__end, self.retries)
+            return data, stat, self.__ranges
+        length = None if self.full else self.__detector.readLength(self.file)
+        data, stat = readConsistentStat(self.file, length, 0, self.retries)
+        layout: Layout = self.__detector.detect(data, self.file)
+        if length is not None and length < layout.end:
+            # The file changed to a version with a longer layout since it was last read
+            data, stat = readConsistentStat(self.file, layout.end, 0, self.retries)
+            layout = self.__detector.detect(data, self.file)
+        if len(data) < layout.end:
+            raise ShortFileError(self.file, len(data), layout.end, stat)
+        return data, stat, layout.ranges
+
+    def poll(self) -> Optional[bytes]:
+        """
+        Check the file once without waiting. The first poll always returns the file's data
+        :return: Raw save data if any known location changed, else None
+        """
+        return self.read() if self.changed() else None
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Poll the file until a known location changes
+        :param timeout: Seconds to wait for. None to wait forever
+        :return: Raw save data, or None if nothing changed in time
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            data = self.poll()
+            if data is not None:
+                return data
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return None
+            self.__sleep(max(0.0, min(self.due, deadline if deadline is not None else self.due) - now))
+
+    def __sleep(self, seconds: float):
+        """
+        Sleep until the next poll is due, waking early if inotify reports the file written or replaced
+        :param seconds: Seconds until the next poll
+        """
+        if self.__inotify is None:
+            try:
+                self.__inotify = _Inotify(self.file)
+            except (OSError, AttributeError, TypeError):
+                self.__inotify = False
+        if self.__inotify and self.__inotify.wait(seconds):
+            # Polled straight away, however far the watcher had backed off
+            self.due = time.monotonic()
+        elif not self.__inotify:
+            time.sleep(seconds)
+
+    def close(self):
+        """
+        Stop watching the file, releasing its inotify watch if wait set one up. Waits after this only poll
+        """
+        if self.__inotify:
+            self.__inotify.close()
+        self.__inotify = False
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as testDirectory:
+        testFile = os.path.join(testDirectory, "slot_0.sav")
+        with open(testFile, "wb") as testSave:
+            testSave.write(b"\0" * 16)
+        testWatcher = SaveWatcher(testFile, 0.01, 0.04, ranges=[(0, 4), (2, 4), (10, 2)])
+        assert testWatcher.poll() is not None, "save watcher fail. First poll did not read the file"
+        assert testWatcher.poll() is None and testWatcher.interval > 0.01, "save watcher fail. Did not back off"
+        time.sleep(0.01)
+        with open(testFile, "r+b") as testSave:
+            testSave.seek(8)
+            testSave.write(b"\2")
+        assert testWatcher.wait(0.1) is None, "save watcher fail. Reported a change outside the known locations"
+        time.sleep(0.01)
+        with open(testFile, "r+b") as testSave:
+            testSave.seek(11)
+            testSave.write(b"\3")
+        testData = testWatcher.wait(1)
+        assert testData is not None and testData[11] == 3, "save watcher fail. Did not report a changed location"
+        assert testWatcher.interval == 0.01, "save watcher fail. Did not speed back up"
+        time.sleep(0.01)
+        with open(testFile, "wb") as testSave:
+            testSave.write(b"\4" * 8)
+        assert testWatcher.poll() is None and testWatcher.invalid, "save watcher fail. Reported a part written file"
+        assert testWatcher.interval > 0.01 and not testWatcher.changed(), "save watcher fail. Kept reading a short file"
+        with open(testFile, "ab") as testSave:
+            testSave.write(b"\4" * 8)
+        testData = testWatcher.wait(1)
+        assert testData == b"\4" * 12, "save watcher fail. Got " + str(testData) + " instead"
+        testData = SaveWatcher(testFile, full=True, ranges=[(0, 12)]).poll()
+        assert testData == b"\4" * 16, "save watcher full read fail. Got " + str(testData) + " instead"
+        testWatcher.close()
+        if sys.platform.startswith("linux"):
+            import threading
+            # Backed off far enough that only inotify can notice the write in time
+            testWatcher = SaveWatcher(testFile, 5, 5, ranges=[(0, 12)])
+            testWatcher.poll()
+
+            def testWrite():
+                with open(testFile, "r+b") as testLater:
+                    testLater.write(b"\5")
+
+            testTimer = threading.Timer(0.05, testWrite)
+            testTimer.start()
+            testStart = time.monotonic()
+            testData = testWatcher.wait(2)
+            testTimer.join()
+            assert testData is not None and testData[0] == 5 and time.monotonic() - testStart < 1, \
+                "save watcher inotify fail. Got " + str(testData) + " instead"
+            testDescriptors = len(os.listdir("/proc/self/fd"))
+            testWatcher.close()
+            testWatcher.close()
+            assert len(os.listdir("/proc/self/fd")) == testDescriptors - 1, "save watcher close fail. Kept its watch"
+            assert testWatcher.wait(0.01) is None, "save watcher closed wait fail"
+
+        # Saves are read up to the end of their own layout, whatever longer layouts other versions have
+        from util.layouts import layouts
+        testVersionField = layouts.default.fieldsByName["version"]
+        testVersion = "9" * testVersionField.length
+        layouts.register(Layout(testVersion, [(testVersionField.offset, testVersionField.length, "version", str),
+                                              (layouts.default.end + 64, 4, "deathcounter", int)]))
+        detector.forget()
+        with open(testFile, "wb") as testSave:
+            testSave.write(b"\1" * layouts.default.end)
+        testWatcher = SaveWatcher(testFile, 0.01, 0.04)
+        testData = testWatcher.poll()
+        assert testData is not None and not testWatcher.invalid, "save watcher fail. Missed a save of a shorter layout"
+        time.sleep(0.01)
+        with open(testFile, "r+b") as testSave:
+            testSave.seek(testVersionField.offset)
+            testSave.write(testVersion.encode())
+        assert testWatcher.wait(0.1) is None and testWatcher.invalid, \
+            "save watcher fail. Reported a save too short for its layout"
+        with open(testFile, "ab") as testSave:
+            testSave.write(b"\1" * 68)
+        testData = testWatcher.wait(1)
+        assert testData is not None and len(testData) == layouts.default.end + 68, \
+            "save watcher fail. Got " + str(testData) + " instead"
+
+    print("All tests passed successfully")
@@ -1,20 +1,35 @@
 """
 Writer class and functions for saving data back into a save file
 """
+import os
 import random
-from typing import Optional
+import shutil
+import tempfile
+import time
+from typing import Optional, List, Dict, Any, Collection, TYPE_CHECKING
 
-from util.locations import locations
+from util import metrics
+from util.layouts import Layout
 from util.save import Save
 
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
 
 class Writer:
     """
     Writer class to handle data saving
     """
-    def __init__(self, save: Optional[Save] = None):
-        self.save = save if save else Save()
-        self.__locations = locations
+    def __init__(self, save: Optional[Save] = None, layout: Optional[Layout] = None):
+        """
+        :param save: Save to source written data from. Ignore to make a new one
+        :param layout: Layout of the game version being written. Ignore to pick each file's layout from its version
+        """
+        # The layout registry is only built once the first reader or writer is made
+        from util.layouts import detector
+        self.layout = layout if layout else detector.registry.default
+        self.save = save if save else Save(self.layout)
+        self.__detector = None if layout else detector
 
     def writeFile(self, file, key: Optional[str] = None, saveOverride: Optional[Save] = None) -> Save:
         """
@@ -29,30 +44,41 @@ class Writer:
         else:
             saveObject = self.save
 
-        savefile = open(file, "r+b")
-        for location in self.__locations:
-            if not key or location[2] == key:
-                if location[2] == "deathcounter":
-                    saveObject.deathcounter = random.randint(1, 200)
-                if location[2] == "timestamp":
-                    saveObject.timestamp = 0
-                if location[2] == "elapsed":
-                    saveObject.elapsed = 30000000
-                if location[2] == "version":
-                    saveObject.version = "6.9.6.9"
-                # TODO - Add shrine support when ready
-                savefile.seek(location[0])
-                locationData = saveObject.get(location[2])
-                locationData = locationData[:location[1]*2]
-                for i in range(0, location[1]*2, 2):
-                    hexData = int(locationData[i:i+2], 16)
-                    byte = hexData.to_bytes(1, "little")
-                    savefile.write(byte)
-                if key:
-                    break
-        savefile.close()
+        keys = self.__keys(key)
+        if "deathcounter" in keys:
+            saveObject.deathcounter = random.randint(1, 200)
+        if "timestamp" in keys:
+            saveObject.timestamp = 0
+        if "elapsed" in keys:
+            saveObject.elapsed = 30000000
+        if "version" in keys:
+            saveObject.version = "6.9.6.9"
+        # TODO - Add shrine support when ready
+        self.__write(file, saveObject, keys)
         return saveObject
 
+    def writeFileInBackground(self, file, key: Optional[str] = None, saveOverride: Optional[Save] = None) -> "Future":
+        """
+        Write the data to the given file on the shared I/O thread
+        :param file: File to open and store data into
+        :param key: Optional specific value to save
+        :param saveOverride: Override for where to source the data
+        :return: Future for the save data
+        """
+        from util import background
+        return background.submit(self.writeFile, file, key, saveOverride)
+
+    async def writeFileAsync(self, file, key: Optional[str] = None, saveOverride: Optional[Save] = None) -> Save:
+        """
+        Write the data to the given file without blocking the event loop
+        :param file: File to open and store data into
+        :param key: Optional specific value to save
+        :param saveOverride: Override for where to source the data
+        :return: Save data
+        """
+        import asyncio
+        return await asyncio.wrap_future(self.writeFileInBackground(file, key, saveOverride))
+
     def _unprotectedWrite(self, file, key: Optional[str] = None, saveOverride: Optional[Save] = None) -> Save:
         """
         Write the data to the given file and save the data. Unprotected version without restrictions.
@@ -66,17 +92,130 @@ class Writer:
         else:
             saveObject = self.save
 
-        savefile = open(file, "r+b")
-        for location in self.__locations:
-            if not key or location[2] == key:
-                savefile.seek(location[0])
-                locationData = saveObject.get(location[2])
-                locationData = locationData[:location[1] * 2]
-                for i in range(0, location[1] * 2, 2):
-                    hexData = int(locationData[i:i + 2], 16)
-                    byte = hexData.to_bytes(1, "little")
-                    savefile.write(byte)
-                if key:
-                    break
-        savefile.close()
+        keys = self.__keys(key)
+        self.__write(file, saveObject, keys)
         return saveObject
+
+    def patchFile(self, file, values: Dict[str, Any]) -> Save:
+        """
+        Write only the given values into the file, leaving everything else untouched
+        :param file: File to open and store data into
+        :param values: Dict of {name: value} to write
+        :return: Save holding the written values
+        """
+        unknown = [key for key in values if key not in self.__known()]
+        if unknown:
+            raise KeyError("No such save value currently known: " + ", ".join(unknown))
+        saveObject = Save(self.layout)
+        for key in values:
+            saveObject.__setattr__(key, values[key])
+        self.__write(file, saveObject, list(values), True)
+        return saveObject
+
+    def __known(self) -> Collection[str]:
+        """
+        Get the names of every value that can be written
+        :return: The layout's names, or every layout's names when each file's layout is picked from its version
+        """
+        return self.layout.fieldsByName if self.__detector is None else self.__detector.registry.names
+
+    def __keys(self, key: Optional[str]) -> List[str]:
+        """
+        Get the names of the values to write
+        :param key: Optional specific value to save
+        :return: All known value names, or just the key if it is known
+        """
+        if not key:
+            return list(self.__known())
+        return [key] if key in self.__known() else []
+
+    def __write(self, file, saveObject: Save, keys: List[str], strict: bool = False):
+        """
+        Patch the given values into the whole file in memory and atomically replace it on disk
+        :param file: File to open and store data into
+        :param saveObject: Save to source the data from
+        :param keys: Names of the values to write. Any the file's layout or the save's layout doesn't have are skipped
+        :param strict: Whether to raise KeyError instead of skipping values the file's layout doesn't have. The given
+        values are written whatever the save's layout is
+        """
+        if not keys:
+            return
+        sink = metrics.sink
+        start = time.perf_counter() if sink is not None else 0
+        with open(file, "rb") as savefile:
+            data = bytearray(savefile.read())
+        layout = self.layout if self.__detector is None else self.__detector.detect(data, file)
+        if strict:
+            missing = [key for key in keys if key not in layout.fieldsByName]
+            if missing:
+                raise KeyError(f'No such save value in the layout of {file}: ' + ", ".join(missing))
+        else:
+            # A save from another game version only has values for the locations of its own layout
+            keys = [key for key in keys if key in layout.fieldsByName and key in saveObject.layout.fieldsByName]
+        layout.codec.encodeInto(data, saveObject, keys)
+
+        directory, name = os.path.split(os.path.abspath(file))
+        handle, tempFile = tempfile.mkstemp(prefix=f'.{name}.', suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(handle, "wb") as savefile:
+                savefile.write(data)
+                savefile.flush()
+                os.fsync(savefile.fileno())
+            shutil.copymode(file, tempFile)
+            os.replace(tempFile, file)
+        except BaseException:
+            os.remove(tempFile)
+            raise
+        if sink is not None:
+            sink.observe("writer_write_seconds", time.perf_counter() - start)
+            sink.count("writer_bytes_read_total", len(data))
+            sink.count("writer_bytes_written_total", len(data))
+
+
+if __name__ == "__main__":
+    import tempfile as testTempfile
+    from reader import Reader
+    from util.layouts import layouts, detector
+
+    # A newer game version keeping its values after the default layout's, with only the version in common
+    testVersionField = layouts.default.fieldsByName["version"]
+    testVersion = "9" * testVersionField.length
+    testLayout = Layout(testVersion, [(testVersionField.offset, testVersionField.length, "version", str),
+                                      (layouts.default.end, 4, "deathcounter", int)])
+    layouts.register(testLayout)
+    detector.forget()
+    with testTempfile.TemporaryDirectory() as testDirectory:
+        testOld = os.path.join(testDirectory, "slot_0.sav")
+        testNew = os.path.join(testDirectory, "slot_1.sav")
+        testData = bytearray(layouts.default.end + 16)
+        testDeathOffset = layouts.default.fieldsByName["deathcounter"].offset
+        testData[testDeathOffset] = 5
+        testData[testVersionField.offset:testVersionField.offset + testVersionField.length] = b"1" * len(testVersion)
+        with open(testOld, "wb") as testSavefile:
+            testSavefile.write(testData)
+        testData[testVersionField.offset:testVersionField.offset + testVersionField.length] = testVersion.encode()
+        testData[layouts.default.end] = 7
+        with open(testNew, "wb") as testSavefile:
+            testSavefile.write(testData)
+
+        testOldSave = Reader().readFile(testOld)
+        testNewSave = Reader().readFile(testNew)
+        assert testNewSave.layout is testLayout and testNewSave.deathcounter == 7, \
+            "writer detect fail. Got " + str(testNewSave.layout) + " instead"
+        # Each save's values land where the file's own layout keeps them
+        Writer()._unprotectedWrite(testNew, saveOverride=testOldSave)
+        with open(testNew, "rb") as testSavefile:
+            testWritten = testSavefile.read()
+        assert testWritten[layouts.default.end] == testOldSave.deathcounter, \
+            "writer old into new version fail. Got " + str(testWritten[layouts.default.end]) + " instead"
+        Writer()._unprotectedWrite(testOld, saveOverride=testNewSave)
+        with open(testOld, "rb") as testSavefile:
+            testWritten = testSavefile.read()
+        assert testWritten[testDeathOffset] == 7, \
+            "writer new into old version fail. Got " + str(testWritten[testDeathOffset]) + " instead"
+        with open(testNew, "wb") as testSavefile:
+            testSavefile.write(testData)
+        Writer().patchFile(testNew, {"deathcounter": 12})
+        assert Reader().readFile(testNew).deathcounter == 12, "writer patch across versions fail"
+
+    print("All tests passed successfully")